@@ -4,7 +4,73 @@ Created on Aug 14, 2013
 @author: justin
 '''
 
-import pygame, gameEngine, random, graphics
+import pygame, gameEngine, graphics
+
+#numpy is optional. Without it every enemy runs its own AI.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+    
+class PatrolSystem(gameEngine.System):
+    # Runs the patrol AI of every awake enemy of one kind at once, before
+    # the enemies are updated. Enemies handled by the system skip their 
+    # own AI for the frame. Does nothing without numpy.
+    # Unlike the per-enemy AI, which runs right after the enemy moved,
+    # the batch runs before the move. It sees the positions and tile
+    # collisions of the frame before, so batched enemies react one frame
+    # later than they would on their own.
+    def __init__(self, ritzTileMap, group, kind):
+        self.ritzTileMap = ritzTileMap
+        self.group = group
+        self.kind = kind
+        
+    def update(self, world):
+        if numpy == None:
+            return
+        sprites = [sprite for sprite in self.group 
+                   if type(sprite) == self.kind and not getattr(sprite, 'asleep', False)]
+        if sprites:
+            self.kind.batchAI(self.ritzTileMap, sprites)
+            
+            
+def getPatrolState(sprites):
+    # Gathers what the patrol rules need from a list of enemies into
+    # arrays: dx, facing, wall collision, tile collision left and right 
+    # and the rects as an (n, 4) array
+    count = len(sprites)
+    dx = numpy.fromiter((sprite.dx for sprite in sprites), float, count)
+    facing = numpy.fromiter((sprite.horizontalFacing for sprite in sprites), int, count)
+    wall = numpy.fromiter((sprite.wallCollision for sprite in sprites), int, count)
+    hitLeft = numpy.fromiter((gameEngine.MySprite.COLLIDE_LEFT in sprite.collisionDirs 
+                              for sprite in sprites), bool, count)
+    hitRight = numpy.fromiter((gameEngine.MySprite.COLLIDE_RIGHT in sprite.collisionDirs 
+                               for sprite in sprites), bool, count)
+    rects = numpy.array([tuple(sprite.rect) for sprite in sprites], dtype = int).reshape(count, 4)
+    return (dx, facing, wall, hitLeft, hitRight, rects)
+
+def getFooting(rects, facingLeft, tileSize):
+    # The batched NavigationMap.getFooting
+    ix = numpy.where(facingLeft, rects[:, 0], rects[:, 0] + rects[:, 2] - 1) // tileSize
+    iy = (rects[:, 1] + rects[:, 3] - 1) // tileSize
+    return (ix, iy)
+
+def getDropDistances(navigation, rects, facingLeft, tileSize):
+    # The batched NavigationMap.getDropDistance
+    (ix, iy) = getFooting(rects, facingLeft, tileSize)
+    noLimit = gameEngine.NavigationMap.NO_LIMIT
+    tiles = navigation.lookupMany(ix, iy, facingLeft, 'ledgeLeft', 'ledgeRight', noLimit)
+    noLedge = tiles == noLimit
+    tiles = numpy.where(noLedge, 0, tiles)
+    distances = numpy.where(facingLeft, rects[:, 0] - (ix - tiles + 1) * tileSize,
+                            (ix + tiles) * tileSize - (rects[:, 0] + rects[:, 2]))
+    return numpy.where(noLedge, noLimit, distances)
+
+def getOverlaps(rects, rect):
+    # Returns which of the rects overlap rect
+    return (rects[:, 0] < rect.right) & (rects[:, 0] + rects[:, 2] > rect.left) & \
+           (rects[:, 1] < rect.bottom) & (rects[:, 1] + rects[:, 3] > rect.top)
 
 
 class ShyGuy(gameEngine.MySprite):
@@ -34,6 +100,7 @@ class ShyGuy(gameEngine.MySprite):
         self.jump = False
         self.onGround = False
         self.falling = False
+        self.aiFrame = -1
         
         self.__resetIdle()
         self.__loadImages()
@@ -42,20 +109,20 @@ class ShyGuy(gameEngine.MySprite):
     def __loadImages(self):
         # Add idle images
         for i in range(self.IDLE_IMG_MAX):
-            self.idleImages.append(pygame.image.load("gfx/enemies/shyguy_idle{0}.png".format(i)))
+            self.idleImages.append(gameEngine.loadImage("gfx/enemies/shyguy_idle{0}.png".format(i)))
         
         # Add Walk images
         for i in range(self.WALK_IMG_MAX):
-            self.walkImages.append(pygame.image.load("gfx/enemies/shyguy_walk{0}.png".format(i)))
+            self.walkImages.append(gameEngine.loadImage("gfx/enemies/shyguy_walk{0}.png".format(i)))
 
     def __resetIdle(self):
         self.idleCounter = 0
         self.idleWaitCounter = 0
         self.originalDX = 0
-        self.idleDelay = random.randint(self.MIN_IDLE_DELAY, self.MAX_IDLE_DELAY)
+        self.idleDelay = self.ritzTileMap.random.randint(self.MIN_IDLE_DELAY, self.MAX_IDLE_DELAY)
         
     def __setUp(self):
-        randomMovement = random.randint(0, 1)
+        randomMovement = self.ritzTileMap.random.randint(0, 1)
         if randomMovement == 0:
             randomMovement = -1
 
@@ -96,8 +163,8 @@ class ShyGuy(gameEngine.MySprite):
             self.hflip()  
             
     def __AI(self):
-        #The AI for shyguy is they move back and forth. They will
-        #fall into pits. After a certain random delay they will stop
+        #The AI for shyguy is they move back and forth. They jump
+        #small gaps and fall into wider pits. After a certain random delay they will stop
         #and stay idle.
         
         if self.falling:
@@ -135,9 +202,9 @@ class ShyGuy(gameEngine.MySprite):
                 self.setDX(-self.WALK_SPEED)
                 
         #Kill Ritz on collison
-        if self.ritzTileMap.ritzSprite != None:
+        if self.ritzTileMap.ritzSprite != None and self.ritzTileMap.ritzSprite.alive():
             if self.collidesWith(self.ritzTileMap.ritzSprite.rect):
-                self.ritzTileMap.ritzSprite.isDead = True
+                self.ritzTileMap.ritzSprite.die()
             
         #Make shy guy jump if there is a tile infront
         if self.horizontalFacing == self.FACE_LEFT:
@@ -147,35 +214,148 @@ class ShyGuy(gameEngine.MySprite):
             adjacentDir = 2
             self.setDX(self.WALK_SPEED)
     
-        #Get tile index of shy guy
+        #Jump over walls up to adjacentDir tiles ahead and over gaps
+        navigation = self.ritzTileMap.getNavigationMap()
         (ixPosition, iyPosition) = self.ritzTileMap.getIndexAt(self.rect.centerx, self.rect.centery)
-        adjacentTile = self.ritzTileMap.getTileAt(ixPosition + adjacentDir, iyPosition)
-        checkAdjacentTile = self.ritzTileMap.isTileCollidable(adjacentTile)
-        
-        if checkAdjacentTile:
+        if navigation.getWallDistance(ixPosition, iyPosition, self.horizontalFacing) <= abs(adjacentDir):
+            self.jump = True
+            
+        (ixLead, iyFeet) = navigation.getFooting(self.rect, self.horizontalFacing)
+        if navigation.getJumpGap(ixLead, iyFeet, self.horizontalFacing) > 0:
             self.jump = True
             
         if self.jump and self.onGround:
             self.setDY(self.JUMP_SPEED)
             self.jump = False
             self.onGround = False
+            
+    @classmethod
+    def batchAI(cls, ritzTileMap, shyGuys):
+        # The same rules as __AI for many shy guys at once
+        count = len(shyGuys)
+        (dx, facing, wall, hitLeft, hitRight, rects) = getPatrolState(shyGuys)
+        onGround = ~numpy.fromiter((shyGuy.falling for shyGuy in shyGuys), bool, count)
+        idle = numpy.fromiter((shyGuy.idle for shyGuy in shyGuys), bool, count)
+        jump = numpy.fromiter((shyGuy.jump for shyGuy in shyGuys), bool, count)
+        idleCounter = numpy.fromiter((shyGuy.idleCounter for shyGuy in shyGuys), int, count)
+        idleDelay = numpy.fromiter((shyGuy.idleDelay for shyGuy in shyGuys), int, count)
+        idleWaitCounter = numpy.fromiter((shyGuy.idleWaitCounter for shyGuy in shyGuys), int, count)
+        originalDX = numpy.fromiter((shyGuy.originalDX for shyGuy in shyGuys), float, count)
+        
+        #Prepare to be idle
+        waiting = idleCounter == idleDelay
+        idleWaitCounter += waiting
+        resume = waiting & (idleWaitCounter == cls.IDLE_WAIT)
+        stop = waiting & ~resume & ~idle
+        dx = numpy.where(resume, originalDX, dx)
+        originalDX = numpy.where(stop, dx, originalDX)
+        dx = numpy.where(stop, 0, dx)
+        idle = (idle | stop) & ~resume
+        idleCounter += ~waiting
+        
+        #Reverse on walls, then on tiles
+        dx = numpy.where(wall == cls.COLLIDE_LEFT, cls.WALK_SPEED, dx)
+        dx = numpy.where(wall == cls.COLLIDE_RIGHT, -cls.WALK_SPEED, dx)
+        dx = numpy.where(hitLeft, -cls.WALK_SPEED, dx)
+        dx = numpy.where(hitRight, cls.WALK_SPEED, dx)
+        facing = numpy.where(dx < 0, cls.FACE_LEFT, numpy.where(dx > 0, cls.FACE_RIGHT, facing))
+        
+        #Kill Ritz on collison
+        ritzSprite = ritzTileMap.ritzSprite
+        if ritzSprite != None and ritzSprite.alive() and getOverlaps(rects, ritzSprite.rect).any():
+            ritzSprite.die()
+            
+        #Jump over walls up to two tiles ahead and over gaps
+        facingLeft = facing == cls.FACE_LEFT
+        dx = numpy.where(facingLeft, -cls.WALK_SPEED, cls.WALK_SPEED)
+        navigation = ritzTileMap.getNavigationMap()
+        tileSize = ritzTileMap.tilesize
+        ix = (rects[:, 0] + rects[:, 2] // 2) // tileSize
+        iy = (rects[:, 1] + rects[:, 3] // 2) // tileSize
+        jump |= navigation.lookupMany(ix, iy, facingLeft, 'wallLeft', 'wallRight', 0) <= 2
+        (ixLead, iyFeet) = getFooting(rects, facingLeft, tileSize)
+        jump |= navigation.lookupMany(ixLead, iyFeet, facingLeft, 'gapLeft', 'gapRight', 0) > 0
+        leap = jump & onGround
+        jump &= ~leap
+        onGround &= ~leap
+        
+        for index, shyGuy in enumerate(shyGuys):
+            shyGuy.aiFrame = ritzTileMap.frameCount
+            shyGuy.idle = bool(idle[index])
+            shyGuy.idleCounter = int(idleCounter[index])
+            shyGuy.idleWaitCounter = int(idleWaitCounter[index])
+            shyGuy.originalDX = float(originalDX[index])
+            shyGuy.jump = bool(jump[index])
+            shyGuy.onGround = bool(onGround[index])
+            shyGuy.setDX(float(dx[index]))
+            if leap[index]:
+                shyGuy.setDY(cls.JUMP_SPEED)
+            if resume[index]:
+                shyGuy.walk = True
+                shyGuy.__resetIdle()
         
     def deductHealth(self, amt):
         self.health -= amt
         if self.health <= 0:
             self.die()
             
+    def runAI(self):
+        #Override to give shy guys another AI
+        self.__AI()
+            
     def update(self):
         gameEngine.MySprite.update(self)
-        self.__AI()
+        if self.aiFrame != self.ritzTileMap.frameCount:
+            self.runAI()
         self.__handleAnimation()
         self.__handleOrientation()
         
     def die(self):
-        bloodSplatter = graphics.BloodSplatter(self.scene, 50, self.rect.center)
+        bloodSplatter = graphics.BloodSplatter(self.scene, self.ritzTileMap, 50, self.rect.center)
         self.ritzTileMap.addGroup(bloodSplatter.getBloodGroup())
         self.kill()
         
+class Chaser(ShyGuy):
+    #A shy guy that follows Ritz across platforms. Chasers share the
+    #tile map's NavigationGraph, so a route to Ritz is only searched
+    #once for all of them until Ritz moves to another tile.
+    
+    def __init__(self, scene, ritzTileMap, center):
+        ShyGuy.__init__(self, scene, ritzTileMap, center)
+        
+    def getNavigationGraph(self):
+        return self.ritzTileMap.getNavigationGraph(self.JUMP_SPEED, self.WALK_SPEED)
+        
+    def runAI(self):
+        graph = self.getNavigationGraph()
+        ritzSprite = self.ritzTileMap.ritzSprite
+        
+        #Kill Ritz on collison
+        if ritzSprite.alive() and self.collidesWith(ritzSprite.rect):
+            ritzSprite.die()
+            
+        #Head for the tile Ritz last stood on
+        goal = graph.getNode(ritzSprite.rect)
+        if goal == None:
+            goal = graph.routeGoal
+        
+        #Steer only while on the ground, keep going while in the air
+        if self.falling:
+            return
+        node = graph.getNode(self.rect)
+        if node == None or goal == None:
+            return
+        
+        nextNode = graph.getNextNode(node, goal)
+        if nextNode == None:
+            self.setDX(0)
+            return
+        
+        direction = cmp(nextNode[0], node[0])
+        self.setDX(direction * self.WALK_SPEED)
+        if graph.getEdgeKind(node, nextNode) == graph.JUMP:
+            self.setDY(self.JUMP_SPEED)
+        
 class Goomba(gameEngine.MySprite):
     
     IDLE_IMG_MAX = 3
@@ -199,6 +379,7 @@ class Goomba(gameEngine.MySprite):
         self.animationDelay = 1
         self.delayCounter = 0
         self.health = self.HEALTH_MAX
+        self.aiFrame = -1
         
         self.__resetIdle()
         self.__loadImages()
@@ -207,20 +388,20 @@ class Goomba(gameEngine.MySprite):
     def __loadImages(self):
         # Add idle images
         for i in range(self.IDLE_IMG_MAX):
-            self.idleImages.append(pygame.image.load("gfx/enemies/goomba_idle{0}.png".format(i)))
+            self.idleImages.append(gameEngine.loadImage("gfx/enemies/goomba_idle{0}.png".format(i)))
         
         # Add Walk images
         for i in range(self.WALK_IMG_MAX):
-            self.walkImages.append(pygame.image.load("gfx/enemies/goomba_walk{0}.png".format(i)))
+            self.walkImages.append(gameEngine.loadImage("gfx/enemies/goomba_walk{0}.png".format(i)))
 
     def __resetIdle(self):
         self.idleCounter = 0
         self.idleWaitCounter = 0
         self.originalDX = 0
-        self.idleDelay = random.randint(self.MIN_IDLE_DELAY, self.MAX_IDLE_DELAY)
+        self.idleDelay = self.ritzTileMap.random.randint(self.MIN_IDLE_DELAY, self.MAX_IDLE_DELAY)
         
     def __setUp(self):
-        randomMovement = random.randint(0, 1)
+        randomMovement = self.ritzTileMap.random.randint(0, 1)
         if randomMovement == 0:
             randomMovement = -1
 
@@ -264,8 +445,8 @@ class Goomba(gameEngine.MySprite):
             self.setDX(self.WALK_SPEED)
             
     def __AI(self):
-        #The AI for goombas is they move back and forth. They will
-        #fall into pits. After a certain random delay they will stop
+        #The AI for goombas is they move back and forth. They turn
+        #around at ledges. After a certain random delay they will stop
         #and stay idle.
         
         #If goomba hits tile (left or right) reverse direction
@@ -298,6 +479,18 @@ class Goomba(gameEngine.MySprite):
         elif self.wallCollision == self.COLLIDE_RIGHT:
             self.setDX(-self.WALK_SPEED)
             
+        #Turn around when this frame's step would take the leading edge
+        #over a ledge, unless there is a ledge just as close behind
+        if not self.falling and self.dx != 0:
+            navigation = self.ritzTileMap.getNavigationMap()
+            speed = abs(self.dx)
+            if self.dx < 0:
+                (ahead, behind) = (self.FACE_LEFT, self.FACE_RIGHT)
+            else:
+                (ahead, behind) = (self.FACE_RIGHT, self.FACE_LEFT)
+            if navigation.getDropDistance(self.rect, ahead) < speed and \
+               navigation.getDropDistance(self.rect, behind) >= speed:
+                self.setDX(-self.dx)
 
                 
         #Kill Ritz on collison
@@ -305,6 +498,38 @@ class Goomba(gameEngine.MySprite):
             if self.collidesWith(self.ritzTileMap.ritzSprite.rect):
                 self.ritzTileMap.ritzSprite.die()
                 
+    @classmethod
+    def batchAI(cls, ritzTileMap, goombas):
+        # The same rules as __AI for many goombas at once
+        (dx, facing, wall, hitLeft, hitRight, rects) = getPatrolState(goombas)
+        
+        #Reverse on tiles, then on walls
+        newDX = numpy.where(hitLeft, -cls.WALK_SPEED, dx)
+        newDX = numpy.where(hitRight, cls.WALK_SPEED, newDX)
+        newDX = numpy.where(wall == cls.COLLIDE_LEFT, cls.WALK_SPEED, newDX)
+        newDX = numpy.where(wall == cls.COLLIDE_RIGHT, -cls.WALK_SPEED, newDX)
+        reverse = hitLeft | hitRight | (wall == cls.COLLIDE_LEFT) | (wall == cls.COLLIDE_RIGHT)
+        
+        #Turn around instead of walking off a ledge
+        falling = numpy.fromiter((goomba.falling for goomba in goombas), bool, len(goombas))
+        navigation = ritzTileMap.getNavigationMap()
+        movingLeft = newDX < 0
+        speed = numpy.abs(newDX)
+        ahead = getDropDistances(navigation, rects, movingLeft, ritzTileMap.tilesize)
+        behind = getDropDistances(navigation, rects, ~movingLeft, ritzTileMap.tilesize)
+        ledge = ~falling & (newDX != 0) & (ahead < speed) & (behind >= speed)
+        newDX = numpy.where(ledge, -newDX, newDX)
+        reverse |= ledge
+        
+        #Kill Ritz on collison
+        ritzSprite = ritzTileMap.ritzSprite
+        if ritzSprite.alive() and getOverlaps(rects, ritzSprite.rect).any():
+            ritzSprite.die()
+            
+        for index, goomba in enumerate(goombas):
+            goomba.aiFrame = ritzTileMap.frameCount
+            if reverse[index]:
+                goomba.setDX(float(newDX[index]))
                 
     def deductHealth(self, amt):
         self.health -= amt
@@ -313,12 +538,13 @@ class Goomba(gameEngine.MySprite):
             
     def update(self):
         gameEngine.MySprite.update(self)
-        self.__AI()
+        if self.aiFrame != self.ritzTileMap.frameCount:
+            self.__AI()
         self.__handleAnimation()
         self.__handleOrientation()
         
     def die(self):
-        bloodSplatter = graphics.BloodSplatter(self.scene, 50, self.rect.center)
+        bloodSplatter = graphics.BloodSplatter(self.scene, self.ritzTileMap, 50, self.rect.center)
         self.ritzTileMap.addGroup(bloodSplatter.getBloodGroup())
         self.kill()
                 
\ No newline at end of file
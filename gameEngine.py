@@ -5,8 +5,143 @@ Created on Aug 1, 2013
 '''
 
 #Import and initialize
-import pygame, math, gameEngineUtil
-pygame.init()
+#pygame subsystems are initialized lazily, see initSubsystem
+import time
+__importStart = time.time()
+import pygame
+__pygameImportTime = time.time() - __importStart
+import array, collections, heapq, math, os, random, struct, threading, Queue, gameEngineUtil
+
+#numpy is optional. It is used for batched random numbers and batched
+#physics when available.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+""" Startup
+    
+    pygame subsystems are initialized the first time they are needed
+    instead of all at once with pygame.init(). Set the RITZ_HEADLESS
+    environment variable to run without a visible window and without
+    the mixer, e.g. for benchmarks. The time taken by imports, subsystem
+    initialization and the first frame is recorded in startupTimes.
+    """
+SUBSYSTEM_DISPLAY = 'display'
+SUBSYSTEM_FONT = 'font'
+SUBSYSTEM_MIXER = 'mixer'
+SUBSYSTEM_JOYSTICK = 'joystick'
+
+HEADLESS = os.environ.get('RITZ_HEADLESS', '') != ''
+
+startupTimes = [('import pygame', __pygameImportTime)]
+__initializedSubsystems = set()
+__failedSubsystems = set()
+__firstFrame = []
+
+def recordStartupTime(name, seconds):
+    startupTimes.append((name, seconds))
+    
+def initSubsystem(name):
+    # Initializes a pygame subsystem if it is not initialized yet. 
+    # Returns True if the subsystem is available.
+    if name in __initializedSubsystems:
+        return True
+    if name in __failedSubsystems or (name == SUBSYSTEM_MIXER and HEADLESS):
+        return False
+    
+    start = time.time()
+    try:
+        if name == SUBSYSTEM_DISPLAY:
+            if HEADLESS:
+                os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+            pygame.display.init()
+        elif name == SUBSYSTEM_FONT:
+            pygame.font.init()
+        elif name == SUBSYSTEM_MIXER:
+            pygame.mixer.init()
+        elif name == SUBSYSTEM_JOYSTICK:
+            pygame.joystick.init()
+    except pygame.error:
+        __failedSubsystems.add(name)
+        return False
+    
+    recordStartupTime('init ' + name, time.time() - start)
+    __initializedSubsystems.add(name)
+    return True
+
+def recordFirstFrame():
+    # Records the time from importing the engine to the first frame shown.
+    if not __firstFrame:
+        __firstFrame.append(time.time())
+        recordStartupTime('first frame', __firstFrame[0] - __importStart)
+        
+def getStartupReport():
+    # Returns the recorded startup times as printable lines
+    lines = []
+    for (name, seconds) in startupTimes:
+        lines.append("{0:<30}{1:>10.1f} ms".format(name, seconds * 1000))
+    return lines
+
+def printStartupReport():
+    for line in getStartupReport():
+        print(line)
+        
+""" Assets
+    
+    Images, fonts and sounds are shared between all sprites asking for
+    the same file, and they initialize their subsystems on first use. When
+    the mixer is not available a silent NullSound is returned instead.
+    Shared images must not be drawn on, copy them first. Shared sounds
+    must not have their volume changed, pass the volume to loadSound 
+    instead to get a sound shared only by callers using that volume.
+    The caches are locked so levels can be loaded on an AsyncLoader.
+    """
+__images = {}
+__fonts = {}
+__sounds = {}
+__assetLock = threading.Lock()
+
+class NullSound():
+    # Stands in for pygame.mixer.Sound when there is no mixer.
+    def play(self, *args):
+        pass
+    
+    def stop(self):
+        pass
+    
+    def set_volume(self, volume):
+        pass
+    
+    def get_volume(self):
+        return 0
+    
+def loadImage(fileName):
+    with __assetLock:
+        if fileName not in __images:
+            __images[fileName] = pygame.image.load(fileName)
+        return __images[fileName]
+
+def getFont(name, size, bold = False, italic = False):
+    key = (name, size, bold, italic)
+    with __assetLock:
+        if key not in __fonts:
+            initSubsystem(SUBSYSTEM_FONT)
+            __fonts[key] = pygame.font.SysFont(name, size, bold, italic)
+        return __fonts[key]
+
+def loadSound(fileName, volume = None):
+    key = (fileName, volume)
+    with __assetLock:
+        if key not in __sounds:
+            if initSubsystem(SUBSYSTEM_MIXER):
+                __sounds[key] = pygame.mixer.Sound(fileName)
+                if volume != None:
+                    __sounds[key].set_volume(volume)
+            else:
+                __sounds[key] = NullSound()
+        return __sounds[key]
+
     
 class Physics():
     # This class holds information about the physics of the game engine.
@@ -26,10 +161,1332 @@ class Boundary():
         self.bottomBound = bottomBound
     
     
+class PhysicsBatch():
+    # Moves MySprite bodies in one vectorized numpy step instead of one
+    # sprite at a time. Positions are kept as floats between frames so
+    # sub-pixel motion is not lost to the integer rect. A body whose rect
+    # was moved by something else (collisions, snapshots) starts again 
+    # from its rect. See TileMap.setBatchedPhysics.
+    def __init__(self):
+        self.pending = []
+        self.slots = {}
+        self.x = numpy.zeros(0)
+        self.y = numpy.zeros(0)
+        self.rectX = numpy.zeros(0)
+        self.rectY = numpy.zeros(0)
+        
+    def add(self, sprite):
+        # Adds a body to the next step
+        self.pending.append(sprite)
+        
+    def __getPositions(self, previous, rectPositions, positions, lastRectPositions):
+        # Keeps the float position of bodies whose rect did not move 
+        # since the last step
+        if len(positions) == 0:
+            return rectPositions.copy()
+        safe = numpy.maximum(previous, 0)
+        kept = (previous >= 0) & (lastRectPositions[safe] == rectPositions)
+        return numpy.where(kept, positions[safe], rectPositions)
+        
+    def step(self, gravity):
+        # Applies gravity and the walking, idle flags, then moves every
+        # body added since the last step. Bodies not added are forgotten.
+        sprites = self.pending
+        self.pending = []
+        count = len(sprites)
+        
+        rectX = numpy.fromiter((sprite.rect.x for sprite in sprites), float, count)
+        rectY = numpy.fromiter((sprite.rect.y for sprite in sprites), float, count)
+        dx = numpy.fromiter((sprite.dx for sprite in sprites), float, count)
+        dy = numpy.fromiter((sprite.dy for sprite in sprites), float, count)
+        falling = numpy.fromiter((sprite.falling for sprite in sprites), bool, count)
+        applyPhysics = numpy.fromiter((sprite.applyPhysics and sprite.bodyType == MySprite.BODY_DYNAMIC 
+                                       for sprite in sprites), bool, count)
+        previous = numpy.fromiter((self.slots.get(sprite, -1) for sprite in sprites), int, count)
+        
+        x = self.__getPositions(previous, rectX, self.x, self.rectX)
+        y = self.__getPositions(previous, rectY, self.y, self.rectY)
+        
+        pulled = falling & applyPhysics
+        dy = dy + pulled * gravity
+        walking = (dx != 0) & ~falling
+        x += dx
+        y += dy
+        
+        self.x = x
+        self.y = y
+        self.rectX = numpy.floor(x)
+        self.rectY = numpy.floor(y)
+        self.slots = dict(zip(sprites, xrange(count)))
+        
+        speed = numpy.hypot(dx, dy)
+        direction = numpy.degrees(numpy.arctan2(-dy, dx))
+        
+        # Only the results are copied back to the sprites
+        for sprite, left, top, spriteDY, isWalking, isPulled, spriteSpeed, spriteDir in \
+            zip(sprites, self.rectX.tolist(), self.rectY.tolist(), dy.tolist(), walking.tolist(),
+                pulled.tolist(), speed.tolist(), direction.tolist()):
+            sprite.rect.topleft = (int(left), int(top))
+            sprite.walking = isWalking
+            sprite.idle = not isWalking
+            if isPulled:
+                sprite.dy = spriteDY
+                sprite.speed = spriteSpeed
+                sprite.dir = spriteDir
+                if spriteDY < 0:
+                    sprite.jumping = True
+                elif spriteDY > 0:
+                    sprite.jumping = False
+    
+    
+class ChunkBuilder(threading.Thread):
+    # Builds tile chunk surfaces on a worker thread. Tile maps post
+    # chunk requests and receive the finished surfaces through their own
+    # result queue, so the main loop never waits on a chunk build.
+    # pygame releases the GIL while blitting. Surfaces are converted to
+    # the display format by the tile map once they are collected.
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.requests = Queue.Queue()
+        
+    def request(self, tileMap, chunk, generation):
+        self.requests.put((tileMap, chunk, generation))
+        
+    def run(self):
+        while True:
+            (tileMap, chunk, generation) = self.requests.get()
+            # Skip chunks of tiles that have changed since the request
+            if generation != tileMap.getChunkGeneration(chunk):
+                continue
+            try:
+                surface = tileMap.buildChunk(chunk)
+            except (pygame.error, IndexError):
+                continue
+            tileMap.chunkResults.put((chunk, generation, surface))
+            
+__chunkBuilder = []
+
+def getChunkBuilder():
+    # Returns the chunk builder shared by all tile maps.
+    # The worker thread is started on first use.
+    if not __chunkBuilder:
+        chunkBuilder = ChunkBuilder()
+        chunkBuilder.start()
+        __chunkBuilder.append(chunkBuilder)
+    return __chunkBuilder[0]
+
+
+class PressedKeys():
+    # Key state built from a list of pressed keys. It can be indexed by
+    # key constant like the result of pygame.key.get_pressed.
+    def __init__(self, pressed = ()):
+        self.pressed = frozenset(pressed)
+        
+    def __getitem__(self, key):
+        return key in self.pressed
+    
+    
+class InputState():
+    # Keyboard state captured once per frame by the scene. Sprites read
+    # the keys from here instead of calling pygame.key.get_pressed
+    # themselves. The state can also be fed from a recording.
+    def __init__(self):
+        self.keys = PressedKeys()
+        self.lastKeys = PressedKeys()
+        
+    def capture(self):
+        # Captures the keyboard state of the new frame
+        self.feed(pygame.key.get_pressed())
+        
+    def feed(self, keys):
+        # Sets the keyboard state of the new frame. keys must be indexable
+        # by key constant.
+        self.lastKeys = self.keys
+        self.keys = keys
+        
+    def isPressed(self, key):
+        # Returns True if the key is held down this frame
+        return bool(self.keys[key])
+    
+    def justPressed(self, key):
+        # Returns True if the key went down this frame
+        return bool(self.keys[key]) and not self.lastKeys[key]
+    
+    def justReleased(self, key):
+        # Returns True if the key went up this frame
+        return not self.keys[key] and bool(self.lastKeys[key])
+    
+    
+""" Replays
+    
+    A replay recorder writes the keyboard state and key events of every
+    frame of a scene, plus the random seed, to a compact binary file.
+    A replay player feeds them back into the scene, so the same game
+    plays out again frame for frame.
+    
+    The header also names the kind of generator tile maps drew their
+    batches of random numbers from. A replay is played back with the
+    same kind, or refused if it is not available.
+    
+    File layout (little endian):
+        header: 4s magic, H version, I seed, B random kind
+        frame:  B pressed key count, H per pressed key,
+                B event count, H event type and I key per event
+    """
+REPLAY_MAGIC = 'RTZR'
+REPLAY_VERSION = 2
+REPLAY_HEADER = '<4sHIB'
+REPLAY_EVENT_TYPES = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP)
+
+# Random generator kinds, see getRandomKind
+RANDOM_PYTHON = 0
+RANDOM_NUMPY_PCG = 1
+RANDOM_NUMPY_MT = 2
+
+__seed = []
+__randomKind = []
+
+def getAvailableRandomKinds():
+    kinds = [RANDOM_PYTHON]
+    if numpy != None:
+        kinds.append(RANDOM_NUMPY_MT)
+        if hasattr(numpy.random, 'default_rng'):
+            kinds.append(RANDOM_NUMPY_PCG)
+    return kinds
+
+def setRandomKind(kind):
+    # Makes tile maps draw their random numbers from this kind of generator
+    if kind not in getAvailableRandomKinds():
+        raise ValueError("random generator kind {0} is not available".format(kind))
+    del __randomKind[:]
+    __randomKind.append(kind)
+    
+def getRandomKind():
+    # Returns the kind of generator tile maps draw their random numbers
+    # from. Defaults to the numpy generator when numpy is available.
+    if not __randomKind:
+        if numpy == None:
+            setRandomKind(RANDOM_PYTHON)
+        elif hasattr(numpy.random, 'default_rng'):
+            setRandomKind(RANDOM_NUMPY_PCG)
+        else:
+            setRandomKind(RANDOM_NUMPY_MT)
+    return __randomKind[0]
+
+def seedRandom(seed):
+    # Seeds the random number generator used by the game
+    del __seed[:]
+    __seed.append(seed)
+    random.seed(seed)
+    
+def getSeed():
+    # Returns the current game seed. A seed is picked if none was set.
+    if not __seed:
+        seedRandom(int(time.time() * 1000) & 0xFFFFFFFF)
+    return __seed[0]
+
+
+class ReplayRecorder():
+    def __init__(self, fileName, seed = None):
+        if seed == None:
+            seed = int(time.time() * 1000) & 0xFFFFFFFF
+        seedRandom(seed)
+        self.file = open(fileName, 'wb')
+        self.file.write(struct.pack(REPLAY_HEADER, REPLAY_MAGIC, REPLAY_VERSION, seed, getRandomKind()))
+        
+    def recordFrame(self, keys, events):
+        # Writes one frame. keys is the result of pygame.key.get_pressed.
+        pressed = [key for key in range(len(keys)) if keys[key]]
+        events = [event for event in events if event.type in REPLAY_EVENT_TYPES]
+        
+        data = [struct.pack('<B', len(pressed))]
+        data.append(struct.pack('<{0}H'.format(len(pressed)), *pressed))
+        data.append(struct.pack('<B', len(events)))
+        for event in events:
+            data.append(struct.pack('<HI', event.type, getattr(event, 'key', 0)))
+        self.file.write(''.join(data))
+        
+    def close(self):
+        self.file.close()
+        
+        
+class ReplayPlayer():
+    def __init__(self, fileName):
+        f = open(fileName, 'rb')
+        data = f.read()
+        f.close()
+        
+        offset = struct.calcsize(REPLAY_HEADER)
+        (magic, version, seed, randomKind) = struct.unpack(REPLAY_HEADER, data[:offset])
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise IOError("{0} is not a replay file".format(fileName))
+        if randomKind not in getAvailableRandomKinds():
+            raise IOError("{0} needs a random generator that is not available".format(fileName))
+        setRandomKind(randomKind)
+        seedRandom(seed)
+        
+        self.frames = []
+        self.frame = 0
+        while offset < len(data):
+            (count,) = struct.unpack_from('<B', data, offset)
+            offset += 1
+            pressed = struct.unpack_from('<{0}H'.format(count), data, offset)
+            offset += count * 2
+            (count,) = struct.unpack_from('<B', data, offset)
+            offset += 1
+            events = []
+            for i in range(count):
+                (eventType, key) = struct.unpack_from('<HI', data, offset)
+                offset += 6
+                if eventType == pygame.QUIT:
+                    events.append(pygame.event.Event(eventType))
+                else:
+                    events.append(pygame.event.Event(eventType, key = key))
+            self.frames.append((PressedKeys(pressed), events))
+            
+    def nextFrame(self):
+        # Returns the (keys, events) of the next frame or None at the end
+        if self.frame >= len(self.frames):
+            return None
+        self.frame += 1
+        return self.frames[self.frame - 1]
+    
+    
+class EventRouter():
+    # Routes events only to the sprites subscribed to their event type,
+    # instead of broadcasting every event to every sprite. Sprites list
+    # the event types they handle in EVENT_TYPES. Sprites that are no
+    # longer alive are dropped the next time an event reaches them.
+    def __init__(self):
+        self.subscribers = {}
+        
+    def subscribe(self, sprite, eventTypes = None):
+        if eventTypes == None:
+            eventTypes = getattr(sprite, 'EVENT_TYPES', ())
+        for eventType in eventTypes:
+            subscribers = self.subscribers.setdefault(eventType, [])
+            if sprite not in subscribers:
+                subscribers.append(sprite)
+                
+    def subscribeGroup(self, group):
+        for sprite in group.sprites():
+            self.subscribe(sprite)
+                
+    def unsubscribe(self, sprite):
+        for subscribers in self.subscribers.values():
+            if sprite in subscribers:
+                subscribers.remove(sprite)
+                
+    def getEventTypes(self):
+        # Returns the event types anyone is subscribed to
+        return [eventType for eventType in self.subscribers if self.subscribers[eventType]]
+    
+    def dispatch(self, event):
+        subscribers = self.subscribers.get(event.type)
+        if not subscribers:
+            return
+        for sprite in list(subscribers):
+            if sprite.alive():
+                sprite.doEvents(event)
+            else:
+                subscribers.remove(sprite)
+
+
+class SpatialHash():
+    # Buckets items by position in square cells of cellSize pixels, so
+    # the items inside a rect can be found without looking at all of them.
+    # Items are points, or rects spanning every cell they overlap. Items
+    # are returned in the order they were first inserted.
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.itemCells = {}
+        self.itemOrder = {}
+        
+    def __getCell(self, (x, y)):
+        return (int(x) // self.cellSize, int(y) // self.cellSize)
+        
+    def __getCells(self, rect):
+        (left, top) = self.__getCell(rect.topleft)
+        (right, bottom) = self.__getCell(rect.bottomright)
+        return [(cx, cy) for cy in xrange(top, bottom + 1) for cx in xrange(left, right + 1)]
+        
+    def __insertCells(self, item, cells):
+        if item in self.itemCells:
+            self.remove(item)
+        if item not in self.itemOrder:
+            self.itemOrder[item] = len(self.itemOrder)
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(item)
+        self.itemCells[item] = cells
+        
+    def insert(self, item, position):
+        self.__insertCells(item, (self.__getCell(position),))
+        
+    def insertRect(self, item, rect):
+        self.__insertCells(item, tuple(self.__getCells(rect)))
+        
+    def remove(self, item):
+        for cell in self.itemCells.pop(item):
+            self.cells[cell].discard(item)
+            if not self.cells[cell]:
+                del self.cells[cell]
+            
+    def move(self, item, position):
+        # Re-buckets an item, only touching the cells if it changed cell
+        cells = (self.__getCell(position),)
+        if self.itemCells.get(item) != cells:
+            self.__insertCells(item, cells)
+        
+    def query(self, rect):
+        # Returns the items in the cells overlapping rect
+        items = set()
+        for cell in self.__getCells(rect):
+            items.update(self.cells.get(cell, ()))
+        return sorted(items, key = self.itemOrder.get)
+
+
+class SpawnRecord():
+    # Stands in for an entity of a tile map that is not instantiated.
+    # The factory is called with the scene, the tile map and the center
+    # to create the sprite once the camera comes near. While the sprite is streamed
+    # out, state holds what captureSpriteState returned for it.
+    # See TileMap.addSpawnRecord.
+    FRESH_FACING = -1
+    def __init__(self, factory, group, center):
+        self.factory = factory
+        self.group = group
+        self.center = center
+        self.startCenter = center
+        self.state = None
+        self.sprite = None
+        
+    def isAlive(self):
+        if self.sprite != None:
+            return self.sprite.alive()
+        return self.state == None or bool(self.state[5])
+    
+    def getFreshState(self):
+        # The state of a record that was never spawned
+        (centerx, centery) = self.startCenter
+        return (centerx, centery, 0, 0, 0, 1, 0, self.FRESH_FACING)
+
+
+class SpriteSnapshot():
+    # The state of a list of sprites at one point in time, packed in a
+    # flat array with STATE_SIZE values per sprite. See TileMap.snapshot.
+    STATE_SIZE = 8
+    def __init__(self, sprites, values, groups):
+        self.sprites = sprites
+        self.values = values
+        self.groups = groups
+        
+    def getState(self, index):
+        return self.values[index * self.STATE_SIZE:(index + 1) * self.STATE_SIZE]
+
+
+class RewindBuffer():
+    # Keeps the last frames of a list of sprites in a ring buffer so
+    # the game can be played backwards. Each frame only stores the state
+    # values that changed since the frame before it, together with their
+    # previous values, so memory stays small and bounded by capacity.
+    def __init__(self, tileMap, sprites, capacity):
+        self.tileMap = tileMap
+        self.sprites = sprites
+        self.frames = collections.deque(maxlen = capacity)
+        self.current = self.__capture()
+        
+    def __capture(self):
+        values = array.array('d')
+        for sprite in self.sprites:
+            values.extend(self.tileMap.captureSpriteState(sprite))
+        return values
+    
+    def record(self):
+        # Records the current frame. Call once per frame.
+        values = self.__capture()
+        current = self.current
+        indexes = array.array('I')
+        previousValues = array.array('d')
+        for index in xrange(len(values)):
+            if values[index] != current[index]:
+                indexes.append(index)
+                previousValues.append(current[index])
+        self.frames.append((indexes, previousValues))
+        self.current = values
+        
+    def rewind(self):
+        # Puts the sprites back one frame. Returns False when there are
+        # no frames left.
+        if not self.frames:
+            return False
+        (indexes, previousValues) = self.frames.pop()
+        changedSprites = set()
+        for index, value in zip(indexes, previousValues):
+            self.current[index] = value
+            changedSprites.add(index / SpriteSnapshot.STATE_SIZE)
+            
+        for spriteIndex in changedSprites:
+            state = self.current[spriteIndex * SpriteSnapshot.STATE_SIZE:(spriteIndex + 1) * SpriteSnapshot.STATE_SIZE]
+            self.tileMap.applySpriteState(self.sprites[spriteIndex], state)
+        return True
+    
+    def clear(self):
+        # Forgets all frames, e.g. after the sprites were moved by a respawn
+        self.frames.clear()
+        self.current = self.__capture()
+
+
+class AsyncLoader(threading.Thread):
+    # Runs a loader function on a worker thread. Use it to build
+    # levels and other heavy objects while the game keeps running, then
+    # swap the result in with getResult once it is ready.
+    def __init__(self, loader, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.loader = loader
+        self.args = args
+        self.result = None
+        self.error = None
+        
+    def run(self):
+        try:
+            self.result = self.loader(*self.args)
+        except Exception as error:
+            self.error = error
+            
+    def isReady(self):
+        # Returns True once the loader has finished
+        return not self.is_alive()
+    
+    def getResult(self):
+        # Returns the loaded object. Blocks if the loader is still running.
+        self.join()
+        if self.error != None:
+            raise self.error
+        return self.result
+
+
+class ComponentStore():
+    # Keeps one kind of component for many entities. Numeric components
+    # are packed in one array of doubles, one row of fields per entity, 
+    # in the order of self.entities. Other components are kept in a list.
+    # Removing an entity moves the last row into its place.
+    def __init__(self, fields = None):
+        self.fields = fields
+        self.entities = []
+        self.indexes = {}
+        if fields == None:
+            self.data = []
+        else:
+            self.width = len(fields)
+            self.fieldIndexes = dict((field, index) for index, field in enumerate(fields))
+            self.data = array.array('d')
+            
+    def __contains__(self, entity):
+        return entity in self.indexes
+    
+    def __len__(self):
+        return len(self.entities)
+            
+    def add(self, entity, value):
+        if entity in self.indexes:
+            self.set(entity, value)
+            return
+        self.indexes[entity] = len(self.entities)
+        self.entities.append(entity)
+        if self.fields == None:
+            self.data.append(value)
+        else:
+            self.data.extend(value)
+            
+    def remove(self, entity):
+        index = self.indexes.pop(entity)
+        last = len(self.entities) - 1
+        if index != last:
+            moved = self.entities[last]
+            self.entities[index] = moved
+            self.indexes[moved] = index
+            if self.fields == None:
+                self.data[index] = self.data[last]
+            else:
+                self.data[index * self.width:(index + 1) * self.width] = \
+                    self.data[last * self.width:(last + 1) * self.width]
+        self.entities.pop()
+        if self.fields == None:
+            self.data.pop()
+        else:
+            del self.data[last * self.width:]
+            
+    def get(self, entity):
+        index = self.indexes[entity]
+        if self.fields == None:
+            return self.data[index]
+        return tuple(self.data[index * self.width:(index + 1) * self.width])
+    
+    def set(self, entity, value):
+        index = self.indexes[entity]
+        if self.fields == None:
+            self.data[index] = value
+        else:
+            self.data[index * self.width:(index + 1) * self.width] = array.array('d', value)
+            
+    def getField(self, entity, field):
+        return self.data[self.indexes[entity] * self.width + self.fieldIndexes[field]]
+    
+    def setField(self, entity, field, value):
+        self.data[self.indexes[entity] * self.width + self.fieldIndexes[field]] = value
+
+
+class World():
+    # Entity component system. Entities are plain ids, their data lives 
+    # in one ComponentStore per component and systems run over the 
+    # entities having the components they need, in the order they were
+    # added. Sprites written the old way can be mirrored with adoptSprite,
+    # and EntitySprite draws and collides an entity like a MySprite, so
+    # classes can be moved over one piece of logic at a time.
+    
+    # Components
+    POSITION = 'position'
+    VELOCITY = 'velocity'
+    HEALTH = 'health'
+    COLLIDER = 'collider'
+    ANIMATION = 'animation'
+    AI = 'ai'
+    SPRITE = 'sprite'
+    
+    # Fields of the numeric components. The others hold objects.
+    COMPONENT_FIELDS = {POSITION: ('x', 'y'),
+                        VELOCITY: ('dx', 'dy'),
+                        HEALTH: ('health',),
+                        COLLIDER: ('width', 'height')}
+    
+    def __init__(self):
+        self.nextEntity = 1
+        self.entities = set()
+        self.stores = {}
+        self.systems = []
+        for name in (self.POSITION, self.VELOCITY, self.HEALTH, self.COLLIDER, 
+                     self.ANIMATION, self.AI, self.SPRITE):
+            self.registerComponent(name, self.COMPONENT_FIELDS.get(name))
+        
+    def registerComponent(self, name, fields = None):
+        # Adds a new kind of component. Pass a tuple of field names to
+        # pack it as numbers.
+        if name not in self.stores:
+            self.stores[name] = ComponentStore(fields)
+        return self.stores[name]
+    
+    def getStore(self, name):
+        return self.stores[name]
+        
+    def createEntity(self):
+        entity = self.nextEntity
+        self.nextEntity += 1
+        self.entities.add(entity)
+        return entity
+    
+    def destroyEntity(self, entity):
+        for store in self.stores.itervalues():
+            if entity in store:
+                store.remove(entity)
+        self.entities.discard(entity)
+        
+    def hasEntity(self, entity):
+        return entity in self.entities
+        
+    def addComponent(self, entity, name, value):
+        self.stores[name].add(entity, value)
+        
+    def removeComponent(self, entity, name):
+        if entity in self.stores[name]:
+            self.stores[name].remove(entity)
+        
+    def getComponent(self, entity, name):
+        # Returns the component of an entity, or None if it has none
+        store = self.stores[name]
+        if entity not in store:
+            return None
+        return store.get(entity)
+    
+    def setComponent(self, entity, name, value):
+        self.stores[name].set(entity, value)
+        
+    def query(self, names, exclude = ()):
+        # Returns the entities having all components in names and none
+        # in exclude. Only the smallest store is walked.
+        stores = sorted([self.stores[name] for name in names], key = len)
+        excluded = [self.stores[name] for name in exclude]
+        entities = []
+        for entity in stores[0].entities:
+            if all(entity in store for store in stores[1:]) and \
+               not any(entity in store for store in excluded):
+                entities.append(entity)
+        return entities
+    
+    def addSystem(self, system):
+        self.systems.append(system)
+        
+    def removeSystem(self, system):
+        self.systems.remove(system)
+        
+    def update(self):
+        for system in self.systems:
+            system.update(self)
+            
+    def adoptSprite(self, sprite):
+        # Mirrors a sprite in a new entity. The sprite keeps its own state,
+        # the SpriteSyncSystem copies it into the components every frame.
+        entity = self.createEntity()
+        self.addComponent(entity, self.SPRITE, sprite)
+        self.addComponent(entity, self.COLLIDER, sprite.rect.size)
+        self.addComponent(entity, self.POSITION, sprite.rect.center)
+        self.addComponent(entity, self.VELOCITY, (sprite.dx, sprite.dy))
+        if hasattr(sprite, 'health'):
+            self.addComponent(entity, self.HEALTH, (sprite.health,))
+        sprite.entity = entity
+        return entity
+    
+    def releaseSprite(self, sprite):
+        # Forgets a sprite added with adoptSprite, or the entity of an
+        # EntitySprite
+        self.destroyEntity(sprite.entity)
+        sprite.entity = None
+
+
+class System():
+    # Runs process once per frame for every entity having COMPONENTS
+    # and none of EXCLUDE. Override update instead to work on the stores
+    # directly.
+    COMPONENTS = ()
+    EXCLUDE = ()
+    def update(self, world):
+        for entity in world.query(self.COMPONENTS, self.EXCLUDE):
+            self.process(world, entity)
+            
+    def process(self, world, entity):
+        pass
+    
+    
+class SpriteSyncSystem(System):
+    # Copies the state of sprites into the components of their entities.
+    # The entities of sprites that were killed are released.
+    COMPONENTS = (World.SPRITE,)
+    def process(self, world, entity):
+        sprite = world.getComponent(entity, World.SPRITE)
+        if not sprite.alive():
+            world.releaseSprite(sprite)
+            return
+        world.setComponent(entity, World.POSITION, sprite.rect.center)
+        world.setComponent(entity, World.VELOCITY, (sprite.dx, sprite.dy))
+        if entity in world.getStore(World.HEALTH):
+            world.setComponent(entity, World.HEALTH, (getattr(sprite, 'health', 0),))
+    
+    
+class AISystem(System):
+    # The ai component is a function called with the world and the entity
+    COMPONENTS = (World.AI,)
+    def process(self, world, entity):
+        world.getComponent(entity, World.AI)(world, entity)
+        
+        
+class AnimationSystem(System):
+    COMPONENTS = (World.ANIMATION,)
+    def process(self, world, entity):
+        world.getComponent(entity, World.ANIMATION).advance()
+        
+        
+class MovementSystem(System):
+    # Moves entities without a sprite, sprites move themselves
+    COMPONENTS = (World.POSITION, World.VELOCITY)
+    EXCLUDE = (World.SPRITE,)
+    def update(self, world):
+        positions = world.getStore(World.POSITION)
+        velocities = world.getStore(World.VELOCITY)
+        for entity in world.query(self.COMPONENTS, self.EXCLUDE):
+            position = positions.indexes[entity] * 2
+            velocity = velocities.indexes[entity] * 2
+            positions.data[position] += velocities.data[velocity]
+            positions.data[position + 1] += velocities.data[velocity + 1]
+
+
+class Animation():
+    # Animation component. Shows each frame for delay frames, looping.
+    def __init__(self, frames, delay):
+        self.frames = frames
+        self.delay = delay
+        self.frame = 0
+        self.counter = 0
+        
+    def advance(self):
+        self.counter += 1
+        if self.counter >= self.delay:
+            self.counter = 0
+            self.frame = (self.frame + 1) % len(self.frames)
+            
+    def getImage(self):
+        return self.frames[self.frame]
+
+
+class TileProperties():
+    # Behaviour of the tiles of a tileset, kept in flat arrays indexed by
+    # tile id so a lookup is a single array read:
+    #   solid: sprites collide with the tile
+    #   hazard: touching the tile hurts, see damage
+    #   oneway: the tile can only be landed on from above
+    #   friction: share of a sprite's dx taken away when it lands on
+    #       the tile, and how fast MySprite.walk changes its speed while
+    #       it stands on it. 1.0 stops and turns sprites right away.
+    #   damage: health taken by a hazard, at most once every
+    #       TileMap.HAZARD_COOLDOWN frames. Only sprites with health 
+    #       (a deductHealth method) take damage, a hazard kills any other
+    #       sprite, and kills every sprite when its damage is 0.
+    #   animated: the tile cycles through the tiles in animations[tile],
+    #       changing every ANIMATION_DELAY frames
+    #   slope: the tile is a slope rising from slopeLeft to slopeRight,
+    #       heights as a share of the tile, e.g. "slope=0:1" for 45 
+    #       degrees or "slope=0:0.5" for the lower half of 22.5 degrees
+    # One-way and slope tiles are surfaces: they are only landed on from
+    # above, see TileMap.getHeightProfiles.
+    # Properties files have one line per tile that is not a default solid
+    # tile, e.g. "20,hazard=1,damage=2" or "5,animated=5|6|7". Lines 
+    # starting with # are comments.
+    ANIMATION_DELAY = 8
+    PROPERTIES = ('solid', 'hazard', 'oneway', 'friction', 'damage', 'animated', 'slope')
+    
+    def __init__(self, count):
+        self.count = count
+        self.solid = array.array('b', [1]) * count
+        self.hazard = array.array('b', [0]) * count
+        self.oneway = array.array('b', [0]) * count
+        self.friction = array.array('d', [1.0]) * count
+        self.damage = array.array('i', [0]) * count
+        self.animated = array.array('b', [0]) * count
+        self.animations = {}
+        self.slope = array.array('b', [0]) * count
+        self.slopeLeft = array.array('d', [0.0]) * count
+        self.slopeRight = array.array('d', [0.0]) * count
+        
+    def set(self, tile, name, value):
+        # Sets a property of a tile. value is a string as read from a 
+        # properties file, or a number. animated takes the frame tiles.
+        if name not in self.PROPERTIES:
+            raise ValueError("unknown tile property " + name)
+        if name == 'animated':
+            if isinstance(value, str):
+                value = [int(frame) for frame in value.split('|')]
+            self.animations[tile] = tuple(value)
+            self.animated[tile] = 1
+        elif name == 'slope':
+            if isinstance(value, str):
+                value = value.split(':')
+            (self.slopeLeft[tile], self.slopeRight[tile]) = (float(value[0]), float(value[1]))
+            self.slope[tile] = 1
+        elif name == 'friction':
+            self.friction[tile] = float(value)
+        else:
+            getattr(self, name)[tile] = int(value)
+            
+    def isSurface(self, tile):
+        return self.oneway[tile] == 1 or self.slope[tile] == 1
+    
+    def isBlock(self, tile):
+        # Solid tiles that are not surfaces block from every side
+        return self.solid[tile] == 1 and not self.isSurface(tile)
+            
+    def getFrame(self, tile, frameCount):
+        # Returns the tile shown for an animated tile at a frame
+        frames = self.animations[tile]
+        return frames[(frameCount / self.ANIMATION_DELAY) % len(frames)]
+            
+    @staticmethod
+    def load(fileName, count):
+        # Reads a properties file for a tileset of count tiles
+        entries = []
+        f = open(fileName, "r")
+        for line in f.readlines():
+            line = line.strip()
+            if line == "" or line.startswith('#'):
+                continue
+            tokens = line.split(',')
+            tile = int(tokens[0])
+            count = max(count, tile + 1)
+            for token in tokens[1:]:
+                (name, value) = token.split('=')
+                entries.append((tile, name.strip(), value.strip()))
+        f.close()
+        
+        properties = TileProperties(count)
+        for (tile, name, value) in entries:
+            properties.set(tile, name, value)
+        return properties
+
+
+class SummedAreaTable():
+    # Summed-area table of a grid of numbers. Each entry holds the total
+    # of all cells above and left of it, so the total of any rectangle of
+    # cells takes four lookups no matter how large it is. Changing a cell
+    # only updates the entries below and right of it.
+    def __init__(self, width, height, value):
+        # value(ix, iy) returns the number in a cell
+        self.width = width
+        self.height = height
+        self.stride = width + 1
+        self.cells = array.array('i', [0]) * (width * height)
+        self.sums = array.array('i', [0]) * (self.stride * (height + 1))
+        for iy in xrange(height):
+            rowTotal = 0
+            above = iy * self.stride
+            for ix in xrange(width):
+                cell = value(ix, iy)
+                self.cells[iy * width + ix] = cell
+                rowTotal += cell
+                self.sums[above + self.stride + ix + 1] = self.sums[above + ix + 1] + rowTotal
+                
+    def getSum(self, ix0, iy0, ix1, iy1):
+        # Returns the total of columns ix0 to ix1 - 1 and rows iy0 to 
+        # iy1 - 1. The parts outside the grid count as 0.
+        ix0 = max(ix0, 0)
+        iy0 = max(iy0, 0)
+        ix1 = min(ix1, self.width)
+        iy1 = min(iy1, self.height)
+        if ix1 <= ix0 or iy1 <= iy0:
+            return 0
+        sums = self.sums
+        stride = self.stride
+        return sums[iy1 * stride + ix1] - sums[iy0 * stride + ix1] - \
+               sums[iy1 * stride + ix0] + sums[iy0 * stride + ix0]
+               
+    def set(self, ix, iy, value):
+        delta = value - self.cells[iy * self.width + ix]
+        if delta == 0:
+            return
+        self.cells[iy * self.width + ix] = value
+        for row in xrange(iy + 1, self.height + 1):
+            offset = row * self.stride
+            for column in xrange(ix + 1, self.width + 1):
+                self.sums[offset + column] += delta
+
+
+class NavigationMap():
+    # Navigation metadata for platformer AI, computed per tile when the
+    # map is loaded and again for the rows around a tile when it changes.
+    # Values are kept in flat arrays indexed by iy * width + ix:
+    #   solid, standable: whether a tile is collidable, and whether it is
+    #       empty with a floor below it that is not a hazard
+    #   wallLeft, wallRight: tiles to the next solid tile in the row
+    #   ledgeLeft, ledgeRight: tiles to the next drop (a tile that is
+    #       neither solid nor standable) before any wall
+    #   gapLeft, gapRight: width of the drop right next to a tile when
+    #       there is floor behind it within MAX_JUMP_GAP tiles, otherwise 0
+    # Distances are NO_LIMIT when there is nothing in that direction.
+    NO_LIMIT = 1 << 30
+    MAX_JUMP_GAP = 3
+    
+    def __init__(self, tileMap):
+        self.tileMap = tileMap
+        (self.width, self.height) = tileMap.getIndexSize()
+        size = self.width * self.height
+        self.solid = array.array('b', [0]) * size
+        self.standable = array.array('b', [0]) * size
+        self.wallLeft = array.array('i', [0]) * size
+        self.wallRight = array.array('i', [0]) * size
+        self.ledgeLeft = array.array('i', [0]) * size
+        self.ledgeRight = array.array('i', [0]) * size
+        self.gapLeft = array.array('i', [0]) * size
+        self.gapRight = array.array('i', [0]) * size
+        for iy in xrange(self.height):
+            self.__buildRow(iy)
+            
+    def __isFloor(self, tile):
+        tileProperties = self.tileMap.getTileProperties()
+        return tileProperties.solid[tile] == 1 and tileProperties.hazard[tile] == 0
+            
+    def __buildRow(self, iy):
+        width = self.width
+        offset = iy * width
+        row = self.tileMap.tiles[iy]
+        below = None
+        if iy + 1 < self.height:
+            below = self.tileMap.tiles[iy + 1]
+            
+        drops = [False] * width
+        tileProperties = self.tileMap.getTileProperties()
+        for ix in xrange(width):
+            # One-way and slope tiles can be walked into, they only
+            # count as floor
+            solid = tileProperties.isBlock(row[ix])
+            standable = not solid and below != None and self.__isFloor(below[ix])
+            self.solid[offset + ix] = solid
+            self.standable[offset + ix] = standable
+            drops[ix] = not solid and not standable
+            
+        self.__scanRow(offset, drops, xrange(width), self.wallLeft, self.ledgeLeft)
+        self.__scanRow(offset, drops, xrange(width - 1, -1, -1), self.wallRight, self.ledgeRight)
+        
+        # Length of the run of drops starting at each tile, walking right
+        dropRuns = [0] * (width + 1)
+        for ix in xrange(width - 1, -1, -1):
+            if drops[ix]:
+                dropRuns[ix] = dropRuns[ix + 1] + 1
+        # And walking left
+        dropRunsLeft = [0] * (width + 1)
+        for ix in xrange(width):
+            if drops[ix]:
+                dropRunsLeft[ix + 1] = dropRunsLeft[ix] + 1
+                
+        for ix in xrange(width):
+            self.gapRight[offset + ix] = 0
+            self.gapLeft[offset + ix] = 0
+            if not self.standable[offset + ix]:
+                continue
+            if ix + 1 < width:
+                gap = dropRuns[ix + 1]
+                landing = ix + 1 + gap
+                if 0 < gap <= self.MAX_JUMP_GAP and landing < width and self.standable[offset + landing]:
+                    self.gapRight[offset + ix] = gap
+            if ix > 0:
+                gap = dropRunsLeft[ix]
+                landing = ix - 1 - gap
+                if 0 < gap <= self.MAX_JUMP_GAP and landing >= 0 and self.standable[offset + landing]:
+                    self.gapLeft[offset + ix] = gap
+                    
+    def __scanRow(self, offset, drops, indexes, walls, ledges):
+        # Fills the wall and ledge distances of a row, walking the indexes
+        # in order so every tile sees the nearest wall and drop behind it
+        lastWall = None
+        lastDrop = None
+        for ix in indexes:
+            index = offset + ix
+            if self.solid[index]:
+                walls[index] = 0
+                ledges[index] = self.NO_LIMIT
+                lastWall = ix
+                lastDrop = None
+                continue
+            walls[index] = self.NO_LIMIT if lastWall == None else abs(ix - lastWall)
+            ledges[index] = self.NO_LIMIT if lastDrop == None else abs(ix - lastDrop)
+            if drops[ix]:
+                lastDrop = ix
+                
+    def updateTile(self, ix, iy):
+        # Rebuilds the rows a changed tile can affect: its own and the one
+        # above it, whose floor it is
+        for row in (iy - 1, iy):
+            if 0 <= row < self.height:
+                self.__buildRow(row)
+                
+    def __getIndex(self, ix, iy):
+        if 0 <= ix < self.width and 0 <= iy < self.height:
+            return iy * self.width + ix
+        return None
+    
+    def __lookup(self, ix, iy, facing, leftValues, rightValues, outside):
+        index = self.__getIndex(ix, iy)
+        if index == None:
+            return outside
+        if facing == MySprite.FACE_LEFT:
+            return leftValues[index]
+        return rightValues[index]
+                
+    def isSolid(self, ix, iy):
+        index = self.__getIndex(ix, iy)
+        return index == None or bool(self.solid[index])
+    
+    def isStandable(self, ix, iy):
+        index = self.__getIndex(ix, iy)
+        return index != None and bool(self.standable[index])
+    
+    def getWallDistance(self, ix, iy, facing):
+        return self.__lookup(ix, iy, facing, self.wallLeft, self.wallRight, 0)
+    
+    def getLedgeDistance(self, ix, iy, facing):
+        return self.__lookup(ix, iy, facing, self.ledgeLeft, self.ledgeRight, self.NO_LIMIT)
+    
+    def getJumpGap(self, ix, iy, facing):
+        return self.__lookup(ix, iy, facing, self.gapLeft, self.gapRight, 0)
+    
+    def getDropDistance(self, rect, facing):
+        # Returns the pixels between the leading edge of a rect and the
+        # next drop in the row of its feet, NO_LIMIT if there is none
+        (ix, iy) = self.getFooting(rect, facing)
+        tiles = self.getLedgeDistance(ix, iy, facing)
+        if tiles == self.NO_LIMIT:
+            return self.NO_LIMIT
+        tileSize = self.tileMap.tilesize
+        if facing == MySprite.FACE_LEFT:
+            return rect.left - (ix - tiles + 1) * tileSize
+        return (ix + tiles) * tileSize - rect.right
+    
+    def getFooting(self, rect, facing):
+        # Returns the index of the leading bottom tile of a rect
+        if facing == MySprite.FACE_LEFT:
+            x = rect.left
+        else:
+            x = rect.right - 1
+        return self.tileMap.getIndexAt(x, rect.bottom - 1)
+    
+    def lookupMany(self, ix, iy, facingLeft, leftName, rightName, outside):
+        # Looks up one pair of arrays (e.g. 'wallLeft', 'wallRight') for 
+        # numpy arrays of indexes at once. Needs numpy.
+        inside = (ix >= 0) & (ix < self.width) & (iy >= 0) & (iy < self.height)
+        index = numpy.where(inside, iy * self.width + ix, 0)
+        leftValues = numpy.frombuffer(getattr(self, leftName), numpy.intc)
+        rightValues = numpy.frombuffer(getattr(self, rightName), numpy.intc)
+        values = numpy.where(facingLeft, leftValues[index], rightValues[index])
+        return numpy.where(inside, values, outside)
+
+
+class NavigationGraph():
+    # Pathfinding graph over the standable tiles of a map. Every standable
+    # tile (ix, iy) is a node. Edges walk to a standable neighbour, fall
+    # off a ledge to the first floor below, or jump to a standable tile 
+    # the arc of jumpSpeed under gravity reaches when walking at walkSpeed.
+    # Routes are found with A* and cached for the current goal: every 
+    # node of a found path remembers its next node, so later searches
+    # towards the same goal stop as soon as they reach a known route.
+    
+    # Edge kinds
+    WALK = 0
+    FALL = 1
+    JUMP = 2
+    
+    # Extra cost of a jump, so walking is preferred when both work
+    JUMP_COST = 2
+    # How many tiles below the start a jump may land
+    JUMP_DROP_TILES = 4
+    
+    def __init__(self, tileMap, jumpSpeed, walkSpeed, gravity):
+        self.navigation = tileMap.getNavigationMap()
+        self.tilesize = tileMap.tilesize
+        self.jumpSpeed = abs(jumpSpeed)
+        self.walkSpeed = abs(walkSpeed)
+        self.gravity = gravity
+        self.jumpTiles = int(self.getJumpHeight(self.jumpSpeed, gravity) // self.tilesize)
+        if self.jumpSpeed > 0 and self.jumpTiles < 1:
+            raise ValueError("a jump speed of {0} can't climb a single tile".format(jumpSpeed))
+        
+        self.edges = {}
+        self.edgeKinds = {}
+        for iy in xrange(self.navigation.height):
+            for ix in xrange(self.navigation.width):
+                if self.navigation.isStandable(ix, iy):
+                    self.__addEdges((ix, iy))
+                    
+        self.routeGoal = None
+        self.routeNext = {}
+        self.unreachable = set()
+        
+    @staticmethod
+    def getJumpHeight(jumpSpeed, gravity):
+        # Returns how many pixels a jump rises, stepping it frame by frame
+        # the way MySprite moves: gravity slows it down before each move
+        height = 0
+        velocity = abs(jumpSpeed) - gravity
+        while velocity > 0:
+            height += velocity
+            velocity -= gravity
+        return height
+        
+    def __addEdge(self, node, target, cost, kind):
+        if (node, target) in self.edgeKinds:
+            return
+        self.edges[node].append((target, cost))
+        self.edgeKinds[(node, target)] = kind
+                    
+    def __addEdges(self, node):
+        navigation = self.navigation
+        (ix, iy) = node
+        self.edges[node] = []
+        for step in (-1, 1):
+            nx = ix + step
+            if navigation.isStandable(nx, iy):
+                self.__addEdge(node, (nx, iy), 1, self.WALK)
+            elif not navigation.isSolid(nx, iy):
+                # Fall down the column next to the ledge
+                ny = iy + 1
+                while ny < navigation.height and not navigation.isStandable(nx, ny) and \
+                      not navigation.isSolid(nx, ny):
+                    ny += 1
+                if navigation.isStandable(nx, ny):
+                    self.__addEdge(node, (nx, ny), 1 + ny - iy, self.FALL)
+                    
+        for ty in xrange(iy - self.jumpTiles, iy + self.JUMP_DROP_TILES + 1):
+            reach = self.__getJumpReach(iy - ty)
+            for tx in xrange(ix - reach, ix + reach + 1):
+                if (tx, ty) != node and navigation.isStandable(tx, ty) and \
+                   self.__isJumpClear(ix, iy, tx, ty):
+                    self.__addEdge(node, (tx, ty), abs(tx - ix) + abs(ty - iy) + self.JUMP_COST, self.JUMP)
+                    
+    def __getJumpReach(self, rise):
+        # Returns how many tiles sideways a jump travels before coming 
+        # down to rise tiles above the start
+        height = rise * self.tilesize
+        velocity = self.jumpSpeed
+        if velocity * velocity < 2 * self.gravity * height:
+            return -1
+        time = (velocity + math.sqrt(velocity * velocity - 2 * self.gravity * height)) / self.gravity
+        return int(time * self.walkSpeed / self.tilesize)
+    
+    def __isJumpClear(self, ix, iy, tx, ty):
+        # Checks that the columns between start and target are free from
+        # the top of the jump down to where the arc passes them
+        apex = max(iy - self.jumpTiles, 0)
+        step = cmp(tx, ix) or 1
+        for column in xrange(ix, tx + step, step):
+            if column == ix:
+                bottom = iy
+            elif column == tx:
+                bottom = ty
+            else:
+                bottom = min(iy, ty)
+            for row in xrange(apex, bottom + 1):
+                if self.navigation.isSolid(column, row):
+                    return False
+        return True
+    
+    def getNode(self, rect):
+        # Returns the node a rect is standing on, or None if it is not on one
+        node = (rect.centerx // self.tilesize, (rect.bottom - 1) // self.tilesize)
+        if node in self.edges:
+            return node
+        return None
+    
+    def getEdgeKind(self, node, target):
+        return self.edgeKinds.get((node, target))
+                    
+    def getNextNode(self, start, goal):
+        # Returns the node to move to from start to get to goal, or None 
+        # if goal can't be reached. Searches only when the route from 
+        # start is not cached yet. Changing the goal drops the cache.
+        if goal != self.routeGoal:
+            self.routeGoal = goal
+            self.routeNext = {goal: None}
+            self.unreachable = set()
+        if start in self.routeNext:
+            return self.routeNext[start]
+        if start in self.unreachable:
+            return None
+        
+        path = self.findPath(start, goal)
+        if path == None:
+            self.unreachable.add(start)
+            return None
+        for node, target in zip(path, path[1:]):
+            self.routeNext.setdefault(node, target)
+        return self.routeNext[start]
+    
+    def findPath(self, start, goal):
+        # A* from start to goal. Stops at the first node with a cached 
+        # route to goal and follows it from there. Returns the list of 
+        # nodes, or None if there is no path.
+        if start not in self.edges or goal not in self.edges:
+            return None
+        (goalX, goalY) = goal
+        routeNext = self.routeNext if goal == self.routeGoal else {goal: None}
+        
+        openNodes = [(0, 0, start)]
+        parents = {start: None}
+        costs = {start: 0}
+        closed = set()
+        while openNodes:
+            (estimate, cost, node) = heapq.heappop(openNodes)
+            if node in closed:
+                continue
+            closed.add(node)
+            if node in routeNext:
+                path = []
+                while node != None:
+                    path.append(node)
+                    node = parents[node]
+                path.reverse()
+                node = routeNext[path[-1]]
+                while node != None:
+                    path.append(node)
+                    node = routeNext[node]
+                return path
+            
+            for (target, edgeCost) in self.edges[node]:
+                targetCost = cost + edgeCost
+                if target not in costs or targetCost < costs[target]:
+                    costs[target] = targetCost
+                    parents[target] = node
+                    heuristic = abs(target[0] - goalX) + abs(target[1] - goalY)
+                    heapq.heappush(openNodes, (targetCost + heuristic, targetCost, target))
+        return None
+
+
 class TileMap(pygame.sprite.Sprite):
     
     DOOM_BOUNDARY_LIMIT = 50
     
+    # Events passed on to the sprites of the map
+    EVENT_TYPES = (pygame.KEYDOWN, pygame.KEYUP)
+    
+    # Chunk Constants
+    # The map is rendered in square chunks of CHUNK_TILES tiles. Chunks
+    # the camera will reach within CHUNK_LOOKAHEAD frames (based on the
+    # scroll velocity) are built ahead of time. Missing chunks are drawn
+    # with the placeholder color until they are ready.
+    CHUNK_TILES = 8
+    CHUNK_LOOKAHEAD = 15
+    CHUNK_PLACEHOLDER_COLOR = (48, 48, 56, 255)
+    
+    # Activation Constants
+    # When an activation margin is set, sprites more than that many pixels
+    # outside the screen are asleep: they are not updated or collided.
+    # With a sleep tick rate of n they are still updated every nth frame.
+    # Sprites with CAN_SLEEP set to False are always awake.
+    ACTIVATION_MARGIN = None
+    SLEEP_TICK_RATE = 0
+    
+    # Streaming Constants
+    # Spawn records are instantiated when they come within the spawn
+    # margin of the screen and turned back into records when their sprite
+    # goes beyond the despawn margin. A spawn margin of None instantiates
+    # every record right away. STREAM_CELL_SIZE is the size of the cells
+    # the records are bucketed in.
+    STREAM_SPAWN_MARGIN = None
+    STREAM_DESPAWN_MARGIN = None
+    STREAM_CELL_SIZE = 256
+    
+    # Cell size of the sprite indexes returned by getSpriteIndex
+    SPRITE_INDEX_CELL_SIZE = 64
+    
+    # Collision Constants
+    # Neighbouring collidable tiles are merged into rects, kept in spatial
+    # indexes with cells of COLLISION_CELL_SIZE pixels. Sprites collide
+    # with the rects, so there are no seams between the tiles of a floor.
+    COLLISION_CELL_SIZE = 128
+    
+    # Frames a sprite hurt by a hazard tile is safe from further damage
+    HAZARD_COOLDOWN = 30
+    
+    # Surface Constants
+    # Sprites standing on a one-way or slope tile follow it down by up to
+    # SURFACE_SNAP pixels a frame, so they stay on downward slopes, and 
+    # step up onto blocks up to SURFACE_SNAP pixels above them at the top
+    # of a slope.
+    SURFACE_SNAP = 8
+    
+    # Tile Masks
+    # Tiles counted by countTilesAt, countTilesIn and isRegionEmpty
+    MASK_COLLIDABLE = 0
+    MASK_HAZARD = 1
+    
+    # Default Tile Properties
+    # Without a properties file every tile is solid except TRANPARENT_TILE,
+    # and SPIKE_TILE, when set, is a hazard. See TileProperties.
+    TRANPARENT_TILE = 0
+    SPIKE_TILE = None
+    
+    # Physics Constants
+    # With BATCHED_PHYSICS the awake MySprite bodies are moved in one 
+    # vectorized PhysicsBatch step instead of one by one. It needs numpy,
+    # without it every sprite moves itself as usual.
+    BATCHED_PHYSICS = False
+    
     def __init__(self, scene):
         pygame.sprite.Sprite.__init__(self)
         self.scene = scene
@@ -38,11 +1495,52 @@ class TileMap(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
         
         self.tileImages = []
+        self.tileProperties = None
+        self.animatedTiles = None
+        self.heightProfiles = None
+        self.tileGrid = None
+        self.navigationMap = None
+        self.navigationGraphs = {}
+        self.collisionIndexes = None
+        self.tileTables = None
         self.groups = []
         self.staticGroups = []
+        self.eventRouter = EventRouter()
+        
+        self.entities = []
+        self.entityGroups = {}
+        self.spawnIndex = SpatialHash(self.STREAM_CELL_SIZE)
+        self.spawnedRecords = []
+        self.spriteIndexes = {}
+        
+        self.world = World()
+        self.world.addSystem(SpriteSyncSystem())
+        self.world.addSystem(AISystem())
+        self.world.addSystem(AnimationSystem())
+        self.world.addSystem(MovementSystem())
+        
+        self.random = random.Random()
+        self.numpyRandom = None
+        self.setSeed(getSeed())
         
         self.scrollx = 0
         self.scrolly = 0
+        self.lastScrollx = 0
+        self.lastScrolly = 0
+        
+        self.chunks = {}
+        self.pendingChunks = set()
+        self.chunkResults = Queue.Queue()
+        self.chunkGeneration = 0
+        self.chunkRevisions = {}
+        self.chunksPrimed = False
+        
+        self.activationMargin = self.ACTIVATION_MARGIN
+        self.sleepTickRate = self.SLEEP_TICK_RATE
+        self.frameCount = 0
+        
+        self.physicsBatch = None
+        self.setBatchedPhysics(self.BATCHED_PHYSICS)
         
         self.boundary = Boundary(False, False, False, False)
         
@@ -50,47 +1548,229 @@ class TileMap(pygame.sprite.Sprite):
     def loadTileImages(self, directory, tileFiles):
         for tileFile in tileFiles:
             self.tileImages.append(pygame.image.load(directory + tileFile))
+            
+    def loadTileProperties(self, fileName):
+        self.setTileProperties(TileProperties.load(fileName, len(self.tileImages)))
+        
+    def setTileProperties(self, tileProperties):
+        # Everything derived from the tiles depends on their properties,
+        # so it is all rebuilt
+        self.tileProperties = tileProperties
+        if hasattr(self, 'tiles'):
+            self.setTiles(self.tiles)
+            
+    def getTileProperties(self):
+        # Returns the TileProperties of the tileset, made from the default
+        # tile constants if no properties were set
+        if self.tileProperties == None:
+            tileProperties = TileProperties(max(len(self.tileImages), self.TRANPARENT_TILE + 1,
+                                                (self.SPIKE_TILE or 0) + 1))
+            tileProperties.set(self.TRANPARENT_TILE, 'solid', 0)
+            if self.SPIKE_TILE != None:
+                tileProperties.set(self.SPIKE_TILE, 'hazard', 1)
+            self.tileProperties = tileProperties
+        return self.tileProperties
+              
+    def setSeed(self, seed):
+        # Seeds the random streams of the map. Entities of the map draw
+        # their random numbers from these streams only, so a map plays
+        # out the same for the same seed no matter what else is running.
+        # The numpy stream is of the kind given by getRandomKind, so 
+        # a replay draws the same numbers wherever it is played.
+        self.seed = seed
+        self.random.seed(seed)
+        randomKind = getRandomKind()
+        if randomKind == RANDOM_NUMPY_PCG:
+            self.numpyRandom = numpy.random.default_rng(seed)
+        elif randomKind == RANDOM_NUMPY_MT:
+            self.numpyRandom = numpy.random.RandomState(seed)
+        else:
+            self.numpyRandom = None
+                
+    def randomSamples(self, count):
+        # Returns a list of count random floats in [0, 1). Drawn in one 
+        # batch from the numpy stream when numpy is available.
+        if self.numpyRandom != None:
+            if hasattr(self.numpyRandom, 'random_sample'):
+                return self.numpyRandom.random_sample(count).tolist()
+            return self.numpyRandom.random(count).tolist()
+        return [self.random.random() for i in range(count)]
               
     def setTileSize(self, size):
         self.tilesize = size
+        self.heightProfiles = None
                                             
     def addGroup(self, group):
         self.groups.append(group)
+        self.eventRouter.subscribeGroup(group)
             
     def addStaticGroup(self, group):
         self.staticGroups.append(group)
+        self.eventRouter.subscribeGroup(group)
         
     def setTiles(self, tokens):
         self.tiles = tokens
-        
-
+        self.tileGrid = None
+        self.navigationMap = None
+        self.navigationGraphs = {}
+        self.collisionIndexes = None
+        self.tileTables = None
+        self.animatedTiles = None
+        self.heightProfiles = None
+        self.invalidateChunks()
+        
+    def setTile(self, ix, iy, tile):
+        # Changes a single tile. Only the chunk holding the tile is rebuilt.
+        self.tiles[iy][ix] = tile
+        if self.tileGrid is not None:
+            self.tileGrid[iy, ix] = tile
+        if self.navigationMap != None:
+            self.navigationMap.updateTile(ix, iy)
+        self.navigationGraphs = {}
+        self.collisionIndexes = None
+        if self.tileTables != None:
+            self.tileTables[self.MASK_COLLIDABLE].set(ix, iy, int(self.isTileCollidable(tile)))
+            self.tileTables[self.MASK_HAZARD].set(ix, iy, int(self.__isHazard(tile)))
+        if self.animatedTiles != None:
+            if self.getTileProperties().animated[tile]:
+                self.animatedTiles.insert((ix, iy), (ix * self.tilesize, iy * self.tilesize))
+            elif (ix, iy) in self.animatedTiles.itemCells:
+                self.animatedTiles.remove((ix, iy))
+        chunk = (ix / self.CHUNK_TILES, iy / self.CHUNK_TILES)
+        self.chunkRevisions[chunk] = self.chunkRevisions.get(chunk, 0) + 1
+        self.pendingChunks.discard(chunk)
+        if chunk in self.chunks:
+            del self.chunks[chunk]
+        
+    def invalidateChunks(self):
+        # Drops every built chunk. Chunks still being built are discarded
+        # when they come back from the chunk builder.
+        self.chunkGeneration += 1
+        self.chunkRevisions = {}
+        self.chunks = {}
+        self.pendingChunks = set()
+        self.chunksPrimed = False
+        
+    def getChunkGeneration(self, chunk):
+        # Returns the tag of the current tiles of a chunk. It changes when
+        # the whole map is invalidated or a tile of the chunk is set, so
+        # chunks built from older tiles can be told apart.
+        return (self.chunkGeneration, self.chunkRevisions.get(chunk, 0))
+        
+    def buildChunk(self, (chunkX, chunkY)):
+        # Renders the tiles of a chunk to a new surface. Called from the
+        # chunk builder thread, or directly when priming the chunks. The
+        # surface is converted by __convertChunk on the main thread.
+        chunkSize = self.CHUNK_TILES * self.tilesize
+        surface = pygame.surface.Surface((chunkSize, chunkSize), pygame.SRCALPHA)
+        (indexWidth, indexHeight) = self.getIndexSize()
+        firstTileIX = chunkX * self.CHUNK_TILES
+        firstTileIY = chunkY * self.CHUNK_TILES
+        tileArea = pygame.rect.Rect((0,0), (self.tilesize, self.tilesize))
+        animated = self.getTileProperties().animated
+        
+        # Animated tiles are left out, they are drawn over the chunks
+        for tileY in range(firstTileIY, min(firstTileIY + self.CHUNK_TILES, indexHeight)):
+            for tileX in range(firstTileIX, min(firstTileIX + self.CHUNK_TILES, indexWidth)):
+                if animated[self.tiles[tileY][tileX]]:
+                    continue
+                surface.blit(self.tileImages[self.tiles[tileY][tileX]], 
+                             ((tileX - firstTileIX) * self.tilesize, (tileY - firstTileIY) * self.tilesize), 
+                             tileArea)
+        return surface
     
-        
+    def __convertChunk(self, surface):
+        # Converts a built chunk to the display format for faster blits.
+        # Only call it on the main thread.
+        if pygame.display.get_surface() != None:
+            surface = surface.convert_alpha()
+        return surface
+    
+    def primeChunks(self):
+        # Builds the chunks visible at the current scroll position right away.
+        # Used when a map is first shown so it does not start out with placeholders.
+        for chunk in self.__getChunkRange(self.scrollx, self.scrolly):
+            if chunk not in self.chunks:
+                self.chunks[chunk] = self.__convertChunk(self.buildChunk(chunk))
+        self.chunksPrimed = True
+        
+    def __getChunkRange(self, scrollx, scrolly):
+        # Returns the chunks covering the screen at the given scroll position
+        chunkSize = self.CHUNK_TILES * self.tilesize
+        (indexWidth, indexHeight) = self.getIndexSize()
+        maxChunkX = (indexWidth - 1) / self.CHUNK_TILES
+        maxChunkY = (indexHeight - 1) / self.CHUNK_TILES
+        
+        firstChunkX = max(0, int(scrollx) / chunkSize)
+        firstChunkY = max(0, int(scrolly) / chunkSize)
+        lastChunkX = min(maxChunkX, (int(scrollx) + self.screen.get_width() - 1) / chunkSize)
+        lastChunkY = min(maxChunkY, (int(scrolly) + self.screen.get_height() - 1) / chunkSize)
+        
+        chunks = []
+        for chunkY in range(firstChunkY, lastChunkY + 1):
+            for chunkX in range(firstChunkX, lastChunkX + 1):
+                chunks.append((chunkX, chunkY))
+        return chunks
+    
+    def __requestChunk(self, chunk):
+        if chunk not in self.chunks and chunk not in self.pendingChunks:
+            self.pendingChunks.add(chunk)
+            getChunkBuilder().request(self, chunk, self.getChunkGeneration(chunk))
+            
+    def __collectChunks(self):
+        # Picks up the chunks finished by the chunk builder
+        while True:
+            try:
+                (chunk, generation, surface) = self.chunkResults.get_nowait()
+            except Queue.Empty:
+                break
+            if generation == self.getChunkGeneration(chunk):
+                self.chunks[chunk] = self.__convertChunk(surface)
+                self.pendingChunks.discard(chunk)
+                
+    def __prefetchChunks(self):
+        # Requests the chunks the camera is heading to, based on scroll velocity
+        velocityx = self.scrollx - self.lastScrollx
+        velocityy = self.scrolly - self.lastScrolly
+        self.lastScrollx = self.scrollx
+        self.lastScrolly = self.scrolly
+        if velocityx == 0 and velocityy == 0:
+            return
+        
+        for chunk in self.__getChunkRange(self.scrollx + velocityx * self.CHUNK_LOOKAHEAD, 
+                                          self.scrolly + velocityy * self.CHUNK_LOOKAHEAD):
+            self.__requestChunk(chunk)
 
     def __renderMap(self):
         screenWidth = self.screen.get_width()
         screenHeight = self.screen.get_height()
+        chunkSize = self.CHUNK_TILES * self.tilesize
         
-        tilesPerRow = screenWidth / self.tilesize + 1
-        tilesPerColumn = screenHeight / self.tilesize + 1
-        
-        firstTileIX = self.scrollx / self.tilesize
-        firstTileIY = self.scrolly / self.tilesize
-        tileOffSetX = firstTileIX * self.tilesize - self.scrollx
-        tileOffSetY = firstTileIY * self.tilesize - self.scrolly
-        originalOffSetX = tileOffSetX
+        if not self.chunksPrimed:
+            self.primeChunks()
+        self.__collectChunks()
         
         self.image = pygame.surface.Surface((screenWidth, screenHeight), pygame.SRCALPHA)
         
-        # Draw the tiles to image
-        for tileY in range(firstTileIY, firstTileIY + tilesPerColumn):
-            for tileX in range(firstTileIX, firstTileIX + tilesPerRow):
-                self.image.blit(self.tileImages[self.tiles[tileY][tileX]], (tileOffSetX, tileOffSetY), 
-                                pygame.rect.Rect((0,0), (self.tilesize, self.tilesize)))
-                tileOffSetX += self.tilesize
-
-            tileOffSetX = originalOffSetX
-            tileOffSetY += self.tilesize
+        # Draw the chunks to image. Chunks that are not built yet are requested
+        # and drawn as placeholders.
+        for chunk in self.__getChunkRange(self.scrollx, self.scrolly):
+            chunkRect = pygame.rect.Rect((chunk[0] * chunkSize - self.scrollx, 
+                                          chunk[1] * chunkSize - self.scrolly), (chunkSize, chunkSize))
+            if chunk in self.chunks:
+                self.image.blit(self.chunks[chunk], chunkRect)
+            else:
+                self.__requestChunk(chunk)
+                self.image.fill(self.CHUNK_PLACEHOLDER_COLOR, chunkRect)
+                
+        # Draw the animated tiles on the screen over the chunks
+        tileProperties = self.getTileProperties()
+        for (ix, iy) in self.__getAnimatedTiles().query(self.__getScreenRect(self.tilesize)):
+            tile = tileProperties.getFrame(self.tiles[iy][ix], self.frameCount)
+            self.image.blit(self.tileImages[tile], (ix * self.tilesize - self.scrollx, 
+                                                    iy * self.tilesize - self.scrolly))
+                
+        self.__prefetchChunks()
   
         self.rect = self.image.get_rect()
         
@@ -134,6 +1814,14 @@ class TileMap(pygame.sprite.Sprite):
 
         for group in self.groups:
             for sprite in group.sprites():
+                if getattr(sprite, 'asleep', False):
+                    continue
+                
+                # Static bodies never move, so they are only checked once
+                if getattr(sprite, 'bodyType', None) == MySprite.BODY_STATIC:
+                    if sprite.staticResolved:
+                        continue
+                    sprite.staticResolved = True
 
                 # Check wall boundaries
                 if sprite.rect.left < 0 and self.boundary.leftBound:
@@ -163,64 +1851,248 @@ class TileMap(pygame.sprite.Sprite):
                     except:
                         pass
                     
-                # Check tile collisions
-                topIndex = int(sprite.rect.top) / self.tilesize
-                bottomIndex = int(sprite.rect.bottom) / self.tilesize + 1
-                leftIndex = int(sprite.rect.left) / self.tilesize
-                rightIndex = int(sprite.rect.right) / self.tilesize + 1
-
-                allTransparent = True
-                sprite.collisionDirs = []
+                # Check tile collisions against the merged tile rects that
+                # reach into the tiles the sprite is on
+                region = self.__getTileRegion(sprite.rect)
+                reach = pygame.rect.Rect(region.left, region.top, region.width, region.height + self.SURFACE_SNAP)
+                if self.isRegionEmpty(reach) and self.isRegionEmpty(region, self.MASK_HAZARD):
+                    sprite.collisionDirs = []
+                    sprite.falling = True
+                    sprite.groundFriction = 1.0
+                    continue
+                tileProperties = self.getTileProperties()
+                (solidIndex, hazardIndex) = self.__getCollisionIndexes()
+                hazards = [block for block in hazardIndex.query(region) if region.colliderect(block)]
+                blocks = [block for block in solidIndex.query(region) if region.colliderect(block)]
+                blocks.extend([block for block in hazards 
+                               if tileProperties.solid[self.__getBlockTile(block)]])
                 
-                for iy in range(topIndex , bottomIndex):
-                    for ix in range(leftIndex, rightIndex):
-                        # Get index size of map. Used for out of bounds checking.
-                        (indexWidth, indexHeight) = self.getIndexSize()
-                        if ix < indexWidth and iy < indexHeight and \
-                        self.tiles[iy][ix] != self.TRANPARENT_TILE:
-                            performCollisionCheck = True
+                #If a hazard is touched, hurt the sprite by its damage,
+                #or kill it if the hazard has no damage or the sprite
+                #has no health
+                if hazards:
+                    damage = max([tileProperties.damage[self.__getBlockTile(block)] for block in hazards])
+                    try:
+                        if damage > 0 and hasattr(sprite, 'deductHealth'):
+                            lastHit = getattr(sprite, 'hazardFrame', None)
+                            if lastHit == None or self.frameCount - lastHit >= self.HAZARD_COOLDOWN:
+                                sprite.hazardFrame = self.frameCount
+                                sprite.deductHealth(damage)
                         else:
-                            performCollisionCheck = False
-                            
-                        if performCollisionCheck:
-                            #If tile is a spike kill the sprite
-                            if self.tiles[iy][ix] == self.SPIKE_TILE:
-                                try:
-                                    sprite.die()
-                                except:
-                                    pass     
-                                         
-                             
-                            
-                            allTransparent = False
-                            tilePosition = (ix * self.tilesize, iy * self.tilesize)
-                            # Get last location
-                            
-                            collisionDirs = sprite.collisionDirection((tilePosition[0], tilePosition[1], 
-                                                                                   self.tilesize, self.tilesize))
-                            sprite.collisionDirs.extend(collisionDirs)
-                            sprite.collisionDirs = list(set(sprite.collisionDirs))
-                            
-                            for direction in collisionDirs:
-                                if direction == sprite.COLLIDE_TOP:
-                                    sprite.rect.bottom = tilePosition[1] 
-                                    sprite.setDY(0)
-                                    sprite.setDX(0)
-                                    sprite.falling = False
-                                elif direction == sprite.COLLIDE_BOTTOM:
-                                    sprite.rect.top = tilePosition[1] + self.tilesize
-                                    sprite.setDY(0)
-                                elif direction == sprite.COLLIDE_LEFT:
-                                    sprite.rect.right = tilePosition[0]
-                                    sprite.setDX(0)
-                                elif direction == sprite.COLLIDE_RIGHT:
-                                    sprite.rect.left = tilePosition[0] + self.tilesize
-                                    sprite.setDX(0)
-
-                if allTransparent:
+                            sprite.die()
+                    except:
+                        pass
+                
+                sprite.collisionDirs = []
+                if sprite.falling:
+                    onSurface = self.__landOnSurface(sprite, 0)
+                else:
+                    onSurface = self.__landOnSurface(sprite, self.SURFACE_SNAP)
+                    
+                for block in blocks:
+                    (blockLeft, blockTop, blockWidth, blockHeight) = block
+                    collisionDirs = sprite.collisionDirection(block)
+                    # At the top of a slope step onto the block instead of 
+                    # running into its side
+                    if onSurface and 0 < sprite.rect.bottom - blockTop <= self.SURFACE_SNAP:
+                        sprite.rect.bottom = blockTop
+                        collisionDirs = [direction for direction in collisionDirs 
+                                         if direction != sprite.COLLIDE_LEFT and direction != sprite.COLLIDE_RIGHT]
+                    sprite.collisionDirs.extend(collisionDirs)
+                    sprite.collisionDirs = list(set(sprite.collisionDirs))
+                    
+                    for direction in collisionDirs:
+                        if direction == sprite.COLLIDE_TOP:
+                            friction = tileProperties.friction[self.__getBlockTile(block)]
+                            sprite.rect.bottom = blockTop
+                            sprite.setDY(0)
+                            if friction >= 1:
+                                sprite.setDX(0)
+                            else:
+                                sprite.setDX(sprite.dx * (1 - friction))
+                            sprite.falling = False
+                        elif direction == sprite.COLLIDE_BOTTOM:
+                            sprite.rect.top = blockTop + blockHeight
+                            sprite.setDY(0)
+                        elif direction == sprite.COLLIDE_LEFT:
+                            sprite.rect.right = blockLeft
+                            sprite.setDX(0)
+                        elif direction == sprite.COLLIDE_RIGHT:
+                            sprite.rect.left = blockLeft + blockWidth
+                            sprite.setDX(0)
+
+                if not blocks and not onSurface:
                     sprite.falling = True
-
+                sprite.groundFriction = self.__getGroundFriction(sprite)
+                    
+    def __getGroundFriction(self, sprite):
+        # Returns the friction of the tile a sprite stands on: the surface
+        # its feet are in, or else the tile below its feet. Sprites in the
+        # air have full control, 1.0.
+        if sprite.falling:
+            return 1.0
+        tileProperties = self.getTileProperties()
+        (indexWidth, indexHeight) = self.getIndexSize()
+        ix = int(sprite.rect.centerx) / self.tilesize
+        if ix < 0 or ix >= indexWidth:
+            return 1.0
+        feet = int(sprite.rect.bottom) - 1
+        for iy in (feet / self.tilesize, (feet + 1) / self.tilesize):
+            if 0 <= iy < indexHeight:
+                tile = self.tiles[iy][ix]
+                if tileProperties.isSurface(tile) or tileProperties.solid[tile]:
+                    return tileProperties.friction[tile]
+        return 1.0
                     
+    def __landOnSurface(self, sprite, snap):
+        # Stands a sprite on the highest one-way or slope tile under its 
+        # feet, with the ground height looked up in the height profiles.
+        # Only surfaces the sprite's previous bottom was at or above count,
+        # plus those up to snap pixels below it. Going up a slope the ground
+        # can rise by one pixel per pixel moved, so slopes also count up to
+        # that far above the previous bottom. Sprites only lose speed to
+        # friction when they land, not while they stay on the surface. 
+        # Returns True if the sprite is on a surface.
+        if sprite.dy < 0:
+            return False
+        profiles = self.getHeightProfiles()
+        tileProperties = self.getTileProperties()
+        tilesize = self.tilesize
+        (indexWidth, indexHeight) = self.getIndexSize()
+        left = int(sprite.rect.left)
+        right = int(sprite.rect.right) - 1
+        bottom = int(sprite.rect.bottom)
+        lastBottom = bottom - int(sprite.dy)
+        climb = abs(int(sprite.dx)) + 1
+        lowest = bottom + snap
+        
+        ground = None
+        groundTile = None
+        for iy in xrange(max((lastBottom - climb) / tilesize, 0), min(lowest / tilesize + 1, indexHeight)):
+            for ix in xrange(max(left / tilesize, 0), min(right / tilesize + 1, indexWidth)):
+                tile = self.tiles[iy][ix]
+                profile = profiles[tile]
+                if profile == None:
+                    continue
+                # Profiles are monotonic, the highest column under the 
+                # sprite is at one of its edges
+                tileLeft = ix * tilesize
+                height = max(profile[max(left - tileLeft, 0)], profile[min(right - tileLeft, tilesize - 1)])
+                surface = (iy + 1) * tilesize - height
+                highest = lastBottom
+                if tileProperties.slope[tile]:
+                    highest -= climb
+                if highest <= surface <= lowest and (ground == None or surface < ground):
+                    ground = surface
+                    groundTile = tile
+                    
+        if ground == None:
+            return False
+        sprite.rect.bottom = ground
+        sprite.setDY(0)
+        if sprite.falling:
+            friction = tileProperties.friction[groundTile]
+            if friction >= 1:
+                sprite.setDX(0)
+            else:
+                sprite.setDX(sprite.dx * (1 - friction))
+            if sprite.COLLIDE_TOP not in sprite.collisionDirs:
+                sprite.collisionDirs.append(sprite.COLLIDE_TOP)
+        sprite.falling = False
+        return True
+    
+    def getHeightProfiles(self):
+        # Returns the height profile of every tile, indexed by tile id: 
+        # None for tiles that are not surfaces, otherwise an array holding
+        # how many pixels from the bottom of the tile each of its columns
+        # is solid. One-way tiles are solid all the way up. Built on first
+        # use for the tile size.
+        if self.heightProfiles == None:
+            tileProperties = self.getTileProperties()
+            tilesize = self.tilesize
+            self.heightProfiles = [None] * tileProperties.count
+            for tile in xrange(tileProperties.count):
+                if tileProperties.slope[tile]:
+                    (left, right) = (tileProperties.slopeLeft[tile], tileProperties.slopeRight[tile])
+                    def height(x):
+                        return (left + (right - left) * x / float(tilesize)) * tilesize
+                    # Each column is as high as the higher of its edges
+                    self.heightProfiles[tile] = array.array('i', 
+                        [int(math.ceil(max(height(column), height(column + 1)) - 1e-9)) 
+                         for column in xrange(tilesize)])
+                elif tileProperties.oneway[tile]:
+                    self.heightProfiles[tile] = array.array('i', [tilesize]) * tilesize
+        return self.heightProfiles
+
+    def __getTileRegion(self, rect):
+        # Returns the rect covering every tile a rect is on, including 
+        # the tiles touching its right and bottom edges
+        tilesize = self.tilesize
+        leftIndex = int(rect.left) / tilesize
+        topIndex = int(rect.top) / tilesize
+        rightIndex = int(rect.right) / tilesize + 1
+        bottomIndex = int(rect.bottom) / tilesize + 1
+        return pygame.rect.Rect(leftIndex * tilesize, topIndex * tilesize, 
+                                (rightIndex - leftIndex) * tilesize, (bottomIndex - topIndex) * tilesize)
+        
+    def __getCollisionIndexes(self):
+        # Returns the spatial indexes of the merged solid and hazard rects,
+        # merging the tiles again if they changed. Only tiles with the same
+        # properties are merged, so the top left tile of a rect stands for
+        # all of it, see __getBlockTile.
+        if self.collisionIndexes == None:
+            tileProperties = self.getTileProperties()
+            
+            def solidKey(tile):
+                if tileProperties.isBlock(tile) and not tileProperties.hazard[tile]:
+                    return (tileProperties.friction[tile],)
+                return None
+            
+            def hazardKey(tile):
+                if tileProperties.hazard[tile]:
+                    return (tileProperties.solid[tile], tileProperties.damage[tile], 
+                            tileProperties.friction[tile])
+                return None
+            
+            self.collisionIndexes = (self.__mergeTiles(solidKey), self.__mergeTiles(hazardKey))
+        return self.collisionIndexes
+    
+    def __getBlockTile(self, (blockLeft, blockTop, blockWidth, blockHeight)):
+        return self.tiles[blockTop / self.tilesize][blockLeft / self.tilesize]
+    
+    def __mergeTiles(self, getKey):
+        # Greedily merges the tiles with the same key into as few rects as 
+        # possible: each rect grows right as far as it can, then down as 
+        # far as the whole row below matches. Tiles with a key of None are
+        # left out. Returns a SpatialHash of the rects as (left, top, 
+        # width, height) tuples in pixels.
+        (indexWidth, indexHeight) = self.getIndexSize()
+        tilesize = self.tilesize
+        used = [[False] * indexWidth for iy in xrange(indexHeight)]
+        index = SpatialHash(self.COLLISION_CELL_SIZE)
+        
+        def isFree(ix, iy, key):
+            return not used[iy][ix] and getKey(self.tiles[iy][ix]) == key
+        
+        for iy in xrange(indexHeight):
+            for ix in xrange(indexWidth):
+                key = getKey(self.tiles[iy][ix])
+                if key == None or used[iy][ix]:
+                    continue
+                width = 1
+                while ix + width < indexWidth and isFree(ix + width, iy, key):
+                    width += 1
+                height = 1
+                while iy + height < indexHeight and \
+                      all(isFree(column, iy + height, key) for column in xrange(ix, ix + width)):
+                    height += 1
+                for row in xrange(iy, iy + height):
+                    for column in xrange(ix, ix + width):
+                        used[row][column] = True
+                block = (ix * tilesize, iy * tilesize, width * tilesize, height * tilesize)
+                index.insertRect(block, pygame.rect.Rect(block))
+        return index
+
     def __checkBounds(self):
         # Checks and adjusts the scroll position so it stays
         # in the bounds of the map.
@@ -241,17 +2113,171 @@ class TileMap(pygame.sprite.Sprite):
             
     def reset(self):
         self.groups = []
+        self.eventRouter = EventRouter()
         self.init()
         
 
         
+    def addEntity(self, sprite, group):
+        # Adds a sprite to one of the map's groups and remembers the group,
+        # so restoring a snapshot can bring the sprite back after it was killed.
+        group.add(sprite)
+        self.entities.append(sprite)
+        self.entityGroups[sprite] = group
+        self.eventRouter.subscribe(sprite)
+        
+    def addSpawnRecord(self, factory, group, center):
+        # Adds an entity that is only instantiated while the camera is
+        # near it, see streamEntities. Snapshots and rewinding treat the
+        # record like any other entity.
+        record = SpawnRecord(factory, group, center)
+        self.entities.append(record)
+        self.spawnIndex.insert(record, center)
+        return record
+    
+    def streamEntities(self):
+        # Instantiates the spawn records near the screen and turns the
+        # sprites of records far from it back into records.
+        if self.STREAM_SPAWN_MARGIN == None:
+            spawnRect = None
+            candidates = [entity for entity in self.entities if isinstance(entity, SpawnRecord)]
+        else:
+            spawnRect = self.__getScreenRect(self.STREAM_SPAWN_MARGIN)
+            candidates = self.spawnIndex.query(spawnRect)
+        
+        for record in candidates:
+            if record.sprite == None and record.isAlive() and \
+               (spawnRect == None or spawnRect.collidepoint(record.center)):
+                self.__spawnRecord(record)
+        
+        if spawnRect == None or self.STREAM_DESPAWN_MARGIN == None:
+            return
+        despawnRect = self.__getScreenRect(self.STREAM_DESPAWN_MARGIN)
+        for record in list(self.spawnedRecords):
+            if not despawnRect.colliderect(record.sprite.rect):
+                self.__despawnRecord(record)
+                
+    def getSpriteIndex(self, group):
+        # Returns a SpatialHash of the rects of the sprites in a group.
+        # It is built on the first call in a frame and shared by the 
+        # other calls in the same frame.
+        (frame, index) = self.spriteIndexes.get(group, (None, None))
+        if frame != self.frameCount:
+            index = SpatialHash(self.SPRITE_INDEX_CELL_SIZE)
+            for sprite in group:
+                index.insertRect(sprite, sprite.rect)
+            self.spriteIndexes[group] = (self.frameCount, index)
+        return index
+                
+    def __getScreenRect(self, margin):
+        return pygame.rect.Rect(self.scrollx - margin, self.scrolly - margin,
+                                self.screen.get_width() + margin * 2,
+                                self.screen.get_height() + margin * 2)
+                
+    def __spawnRecord(self, record):
+        sprite = record.factory(self.scene, self, record.center)
+        record.sprite = sprite
+        self.spawnedRecords.append(record)
+        self.entityGroups[sprite] = record.group
+        record.group.add(sprite)
+        self.eventRouter.subscribe(sprite)
+        if record.state != None:
+            self.applySpriteState(sprite, record.state)
+            
+    def __despawnRecord(self, record):
+        sprite = record.sprite
+        record.state = self.captureSpriteState(sprite)
+        record.center = sprite.rect.center
+        record.sprite = None
+        self.spawnedRecords.remove(record)
+        del self.entityGroups[sprite]
+        sprite.kill()
+        self.spawnIndex.move(record, record.center)
+        
+    def __resetRecord(self, record):
+        if record.sprite != None:
+            record.sprite.kill()
+            del self.entityGroups[record.sprite]
+            self.spawnedRecords.remove(record)
+            record.sprite = None
+        record.state = None
+        record.center = record.startCenter
+        self.spawnIndex.move(record, record.center)
+        
+    def captureSpriteState(self, sprite):
+        # Returns the state of a sprite as a tuple of numbers:
+        # center x, center y, dx, dy, health, alive, falling, facing
+        if isinstance(sprite, SpawnRecord):
+            if sprite.sprite != None:
+                return self.captureSpriteState(sprite.sprite)
+            if sprite.state != None:
+                return sprite.state
+            return sprite.getFreshState()
+        return (sprite.rect.centerx, sprite.rect.centery, sprite.dx, sprite.dy, 
+                getattr(sprite, 'health', 0), sprite.alive(), sprite.falling, 
+                sprite.horizontalFacing)
+    
+    def applySpriteState(self, sprite, state):
+        # Puts a sprite back into a state returned by captureSpriteState
+        if isinstance(sprite, SpawnRecord):
+            record = sprite
+            if state[7] == SpawnRecord.FRESH_FACING:
+                self.__resetRecord(record)
+            elif record.sprite != None:
+                self.applySpriteState(record.sprite, state)
+            else:
+                record.state = tuple(state)
+                record.center = (int(state[0]), int(state[1]))
+                self.spawnIndex.move(record, record.center)
+            return
+        
+        (centerx, centery, dx, dy, health, alive, falling, facing) = state
+        sprite.rect.center = (int(centerx), int(centery))
+        sprite.staticResolved = False
+        sprite.setDX(dx)
+        sprite.setDY(dy)
+        sprite.falling = bool(falling)
+        sprite.horizontalFacing = int(facing)
+        if hasattr(sprite, 'health'):
+            sprite.health = health
+        sprite.isDead = not alive
+        
+        if alive and not sprite.alive():
+            self.entityGroups[sprite].add(sprite)
+            self.eventRouter.subscribe(sprite)
+        elif not alive and sprite.alive():
+            sprite.kill()
+        
+    def snapshot(self, sprites = None, includeGroups = True):
+        # Captures the state of the given sprites (all entities by default) 
+        # into a SpriteSnapshot. With includeGroups, groups added to the map 
+        # after the snapshot (bullets, blood) are dropped when it is restored.
+        if sprites == None:
+            sprites = list(self.entities)
+        values = array.array('d')
+        for sprite in sprites:
+            values.extend(self.captureSpriteState(sprite))
+            
+        groups = None
+        if includeGroups:
+            groups = list(self.groups)
+        return SpriteSnapshot(sprites, values, groups)
+    
+    def restore(self, snapshot):
+        # Puts the sprites of a snapshot back in one pass. No sprites or 
+        # assets are created.
+        for index, sprite in enumerate(snapshot.sprites):
+            self.applySpriteState(sprite, snapshot.getState(index))
+        if snapshot.groups != None:
+            self.groups = list(snapshot.groups)
+        
     def grabGroups(self):
         #Returns the tile maps entities (group)
         return self.groups
     
     def addSprite(self, sprite):
         # Create group for sprite, then pass into groups
-        self.groups.append(pygame.sprite.Group(sprite))
+        self.addGroup(pygame.sprite.Group(sprite))
         
     def setScrollPosition(self, xAmt, yAmt):
         # Sets the scroll positions. This dictates
@@ -263,6 +2289,52 @@ class TileMap(pygame.sprite.Sprite):
         self.__checkBounds()
         
                 
+    def setActivationRegion(self, margin, sleepTickRate = 0):
+        # Puts sprites more than margin pixels outside the screen to sleep.
+        # Sleeping sprites are updated every sleepTickRate frames, or never
+        # if it is 0. A margin of None keeps every sprite awake.
+        self.activationMargin = margin
+        self.sleepTickRate = sleepTickRate
+        if margin == None:
+            # Sprites are no longer put to sleep or woken up, so wake
+            # the sleeping ones now or they would never collide again
+            for group in self.groups:
+                for sprite in group.sprites():
+                    sprite.asleep = False
+        
+    def setBatchedPhysics(self, enabled):
+        # Moves the sprites of the map with a PhysicsBatch. Returns False
+        # if batched physics is not available.
+        if enabled and numpy != None:
+            self.physicsBatch = PhysicsBatch()
+        else:
+            self.physicsBatch = None
+            for group in self.groups:
+                for sprite in group:
+                    sprite.batchedPhysics = False
+        return self.physicsBatch != None
+        
+    def __updateGroup(self, group, activationRect):
+        # Updates the awake sprites of a group. Whether a sprite is awake
+        # only depends on its position, the scroll position and the frame
+        # count, so sleeping and waking up is deterministic.
+        if activationRect == None and self.physicsBatch == None:
+            group.update()
+            return
+        
+        tick = self.sleepTickRate > 0 and self.frameCount % self.sleepTickRate == 0
+        for sprite in group.sprites():
+            if activationRect != None:
+                sprite.asleep = getattr(sprite, 'CAN_SLEEP', True) and not tick and \
+                                not activationRect.colliderect(sprite.rect)
+                if sprite.asleep:
+                    continue
+            if self.physicsBatch != None and isinstance(sprite, MySprite) and sprite.CAN_BATCH and \
+               sprite.bodyType != MySprite.BODY_STATIC:
+                sprite.batchedPhysics = True
+                self.physicsBatch.add(sprite)
+            sprite.update()
+        
     def setBoundary(self, leftBound, topBound, rightBound, bottomBound):
         self.boundary.leftBound = leftBound
         self.boundary.topBound = topBound
@@ -282,11 +2354,213 @@ class TileMap(pygame.sprite.Sprite):
     def getTileAt(self, ix, iy):
         return self.tiles[iy][ix]
     
-    def isTileCollidable(self, tile):
-        if tile == self.TRANPARENT_TILE:
-            return False
+    def getTileGrid(self):
+        # Returns the tiles as a numpy array indexed [iy, ix] for batched
+        # lookups, or None without numpy. Kept up to date by setTile.
+        if numpy == None:
+            return None
+        if self.tileGrid is None:
+            self.tileGrid = numpy.array(self.tiles, dtype = int)
+        return self.tileGrid
+    
+    def raycast(self, origin, direction, maxDist):
+        # Walks a ray through the tiles it crosses (DDA) and returns the
+        # first block tile it hits within maxDist pixels as a tuple
+        # (hit x, hit y, ix, iy, distance), or None. One-way and slope 
+        # tiles don't stop rays. A ray starting inside a block tile hits
+        # it at distance 0.
+        (originX, originY) = origin
+        (dirX, dirY) = direction
+        length = math.hypot(dirX, dirY)
+        if length == 0:
+            return None
+        dirX /= float(length)
+        dirY /= float(length)
+        
+        tilesize = self.tilesize
+        (indexWidth, indexHeight) = self.getIndexSize()
+        ix = int(math.floor(originX / float(tilesize)))
+        iy = int(math.floor(originY / float(tilesize)))
+        stepX = cmp(dirX, 0)
+        stepY = cmp(dirY, 0)
+        
+        # Distance along the ray to the next vertical and horizontal tile
+        # edge, and between two of them
+        infinity = float('inf')
+        if dirX > 0:
+            maxX = ((ix + 1) * tilesize - originX) / dirX
+        elif dirX < 0:
+            maxX = (ix * tilesize - originX) / dirX
+        else:
+            maxX = infinity
+        if dirY > 0:
+            maxY = ((iy + 1) * tilesize - originY) / dirY
+        elif dirY < 0:
+            maxY = (iy * tilesize - originY) / dirY
         else:
-            return True
+            maxY = infinity
+        deltaX = tilesize / abs(dirX) if dirX != 0 else infinity
+        deltaY = tilesize / abs(dirY) if dirY != 0 else infinity
+        
+        tileProperties = self.getTileProperties()
+        distance = 0
+        while distance <= maxDist:
+            if ix < 0 or iy < 0 or ix >= indexWidth or iy >= indexHeight:
+                return None
+            if tileProperties.isBlock(self.tiles[iy][ix]):
+                return (originX + dirX * distance, originY + dirY * distance, ix, iy, distance)
+            if maxX < maxY:
+                ix += stepX
+                distance = maxX
+                maxX += deltaX
+            else:
+                iy += stepY
+                distance = maxY
+                maxY += deltaY
+        return None
+    
+    def lineOfSight(self, a, b):
+        # Returns True if no block tile lies between points a and b
+        distance = math.hypot(b[0] - a[0], b[1] - a[1])
+        hit = self.raycast(a, (b[0] - a[0], b[1] - a[1]), distance)
+        return hit == None or hit[4] >= distance
+    
+    def raycastMany(self, origins, directions, maxDist):
+        # raycast for many rays at once. All rays step through the tiles
+        # together in numpy arrays, so the cost is set by the longest ray.
+        # Returns a list of hits or None, like raycast.
+        if numpy == None:
+            return [self.raycast(origin, direction, maxDist) 
+                    for origin, direction in zip(origins, directions)]
+        
+        count = len(origins)
+        if count == 0:
+            return []
+        origins = numpy.array(origins, dtype = float).reshape(count, 2)
+        directions = numpy.array(directions, dtype = float).reshape(count, 2)
+        length = numpy.hypot(directions[:, 0], directions[:, 1])
+        active = length > 0
+        directions /= numpy.where(active, length, 1)[:, numpy.newaxis]
+        (originX, originY) = (origins[:, 0], origins[:, 1])
+        (dirX, dirY) = (directions[:, 0], directions[:, 1])
+        
+        tilesize = self.tilesize
+        tileProperties = self.getTileProperties()
+        blocks = numpy.array(tileProperties.solid, dtype = bool) & \
+                 ~numpy.array(tileProperties.oneway, dtype = bool) & \
+                 ~numpy.array(tileProperties.slope, dtype = bool)
+        solid = blocks[self.getTileGrid()]
+        (indexHeight, indexWidth) = solid.shape
+        ix = numpy.floor(originX / tilesize).astype(int)
+        iy = numpy.floor(originY / tilesize).astype(int)
+        stepX = numpy.sign(dirX).astype(int)
+        stepY = numpy.sign(dirY).astype(int)
+        
+        absX = numpy.abs(dirX)
+        absY = numpy.abs(dirY)
+        safeX = numpy.where(absX > 0, absX, 1)
+        safeY = numpy.where(absY > 0, absY, 1)
+        edgeX = numpy.where(dirX > 0, (ix + 1) * tilesize - originX, originX - ix * tilesize)
+        edgeY = numpy.where(dirY > 0, (iy + 1) * tilesize - originY, originY - iy * tilesize)
+        maxX = numpy.where(absX > 0, edgeX / safeX, numpy.inf)
+        maxY = numpy.where(absY > 0, edgeY / safeY, numpy.inf)
+        deltaX = numpy.where(absX > 0, tilesize / safeX, numpy.inf)
+        deltaY = numpy.where(absY > 0, tilesize / safeY, numpy.inf)
+        
+        distance = numpy.zeros(count)
+        hitDistance = numpy.full(count, -1.0)
+        hitX = numpy.zeros(count, int)
+        hitY = numpy.zeros(count, int)
+        while True:
+            active &= (distance <= maxDist) & (ix >= 0) & (iy >= 0) & (ix < indexWidth) & (iy < indexHeight)
+            if not active.any():
+                break
+            hit = active.copy()
+            hit[active] = solid[iy[active], ix[active]]
+            hitDistance[hit] = distance[hit]
+            hitX[hit] = ix[hit]
+            hitY[hit] = iy[hit]
+            active &= ~hit
+            
+            alongX = active & (maxX < maxY)
+            alongY = active & ~(maxX < maxY)
+            ix = numpy.where(alongX, ix + stepX, ix)
+            iy = numpy.where(alongY, iy + stepY, iy)
+            distance = numpy.where(alongX, maxX, numpy.where(alongY, maxY, distance))
+            maxX = numpy.where(alongX, maxX + deltaX, maxX)
+            maxY = numpy.where(alongY, maxY + deltaY, maxY)
+            
+        hits = []
+        for index in xrange(count):
+            if hitDistance[index] < 0:
+                hits.append(None)
+            else:
+                hitDist = float(hitDistance[index])
+                hits.append((float(originX[index] + dirX[index] * hitDist), 
+                             float(originY[index] + dirY[index] * hitDist),
+                             int(hitX[index]), int(hitY[index]), hitDist))
+        return hits
+    
+    def __isHazard(self, tile):
+        return self.getTileProperties().hazard[tile] == 1
+    
+    def __getAnimatedTiles(self):
+        # Returns a SpatialHash of the (ix, iy) of every animated tile,
+        # building it on first use
+        if self.animatedTiles == None:
+            animated = self.getTileProperties().animated
+            (indexWidth, indexHeight) = self.getIndexSize()
+            self.animatedTiles = SpatialHash(self.CHUNK_TILES * self.tilesize)
+            for iy in xrange(indexHeight):
+                for ix in xrange(indexWidth):
+                    if animated[self.tiles[iy][ix]]:
+                        self.animatedTiles.insert((ix, iy), (ix * self.tilesize, iy * self.tilesize))
+        return self.animatedTiles
+    
+    def getTileTables(self):
+        # Returns the SummedAreaTables of the tile masks, indexed by the
+        # MASK constants, building them on first use
+        if self.tileTables == None:
+            (indexWidth, indexHeight) = self.getIndexSize()
+            self.tileTables = (SummedAreaTable(indexWidth, indexHeight, 
+                                               lambda ix, iy: int(self.isTileCollidable(self.tiles[iy][ix]))),
+                               SummedAreaTable(indexWidth, indexHeight, 
+                                               lambda ix, iy: int(self.__isHazard(self.tiles[iy][ix]))))
+        return self.tileTables
+    
+    def countTilesAt(self, ix0, iy0, ix1, iy1, mask = MASK_COLLIDABLE):
+        # Returns how many tiles of the mask are in columns ix0 to ix1 - 1
+        # and rows iy0 to iy1 - 1, in constant time
+        return self.getTileTables()[mask].getSum(ix0, iy0, ix1, iy1)
+    
+    def countTilesIn(self, rect, mask = MASK_COLLIDABLE):
+        # Returns how many tiles of the mask overlap a rect in pixels
+        tilesize = self.tilesize
+        return self.countTilesAt(int(rect.left) // tilesize, int(rect.top) // tilesize,
+                                 (int(rect.right) - 1) // tilesize + 1, 
+                                 (int(rect.bottom) - 1) // tilesize + 1, mask)
+        
+    def isRegionEmpty(self, rect, mask = MASK_COLLIDABLE):
+        return self.countTilesIn(rect, mask) == 0
+    
+    def getNavigationMap(self):
+        # Returns the NavigationMap of the tiles, building it on first use
+        if self.navigationMap == None:
+            self.navigationMap = NavigationMap(self)
+        return self.navigationMap
+    
+    def getNavigationGraph(self, jumpSpeed, walkSpeed):
+        # Returns the NavigationGraph for sprites jumping and walking at
+        # these speeds, building it on first use. Sprites with the same 
+        # speeds share the graph and its cached routes.
+        key = (jumpSpeed, walkSpeed)
+        if key not in self.navigationGraphs:
+            self.navigationGraphs[key] = NavigationGraph(self, jumpSpeed, walkSpeed, 
+                                                         self.scene.physics.GRAVITY)
+        return self.navigationGraphs[key]
+    
+    def isTileCollidable(self, tile):
+        return self.getTileProperties().solid[tile] == 1
         
     def getIndexAt(self, x, y):
         return (int(x / self.tilesize), int(y / self.tilesize))
@@ -300,24 +2574,39 @@ class TileMap(pygame.sprite.Sprite):
         #Updates the following: events, group collision detection,
         #and render adjustment based on group. When overriden
         #the base class update method must be called.
+        
+        self.frameCount += 1
+        self.streamEntities()
+        # Systems run before the groups update, so batched AI acts on 
+        # the state of the last frame
+        self.world.update()
+        activationRect = None
+        if self.activationMargin != None:
+            activationRect = pygame.rect.Rect(self.scrollx - self.activationMargin, 
+                                              self.scrolly - self.activationMargin,
+                                              self.screen.get_width() + self.activationMargin * 2, 
+                                              self.screen.get_height() + self.activationMargin * 2)
 
         for group in self.groups:
-            group.update()     
+            self.__updateGroup(group, activationRect)
 
         for staticGroup in self.staticGroups:
             staticGroup.update()
             
+        if self.physicsBatch != None:
+            self.physicsBatch.step(self.scene.physics.GRAVITY)
+            
         self.__checkGroupBounds()
+        self.render()
+        
+    def render(self):
+        # Renders the map and its sprites without updating them
         self.__renderMap()
         self.__renderGroups()
 
     def doEvents(self, event):
-        for group in self.groups:
-            for sprite in group:
-                sprite.doEvents(event)
-        for staticGroup in self.staticGroups:
-            for staticSprite in staticGroup:
-                staticSprite.doEvents(event)
+        # Only sprites subscribed to the event type get the event
+        self.eventRouter.dispatch(event)
         
     
 class MySprite(pygame.sprite.Sprite):
@@ -339,12 +2628,32 @@ class MySprite(pygame.sprite.Sprite):
     FACE_DOWN = 2
     FACE_LEFT = 3
     
+    # Event types passed to doEvents. Override to handle events.
+    EVENT_TYPES = ()
+    
+    # Set to False for sprites that must be updated even when they
+    # are far away from the screen (see TileMap.setActivationRegion)
+    CAN_SLEEP = True
+    
+    # Set to False for sprites that must move themselves during their
+    # update (see TileMap.setBatchedPhysics)
+    CAN_BATCH = True
+    
+    # Body Types
+    # Dynamic bodies are moved by their dx, dy and gravity. Kinematic
+    # bodies are only moved by their dx, dy. Static bodies never move and
+    # are collided with the tiles once, when they are first added.
+    BODY_DYNAMIC = 0
+    BODY_KINEMATIC = 1
+    BODY_STATIC = 2
+    BODY_TYPE = BODY_DYNAMIC
+    
     def __init__(self, scene, center, imageName = ""):
         pygame.sprite.Sprite.__init__(self)
         if imageName == "":
             self.masterImage = pygame.surface.Surface((0, 0), pygame.SRCALPHA)
         else:
-            self.masterImage = pygame.image.load(gameEngineUtil.DIR_GFX + imageName)
+            self.masterImage = loadImage(gameEngineUtil.DIR_GFX + imageName)
         self.scene = scene
         self.image = self.masterImage
         self.rect = self.image.get_rect()
@@ -359,6 +2668,7 @@ class MySprite(pygame.sprite.Sprite):
         self.wallCollision = self.COLLIDE_NONE
         self.touchingWall = False
         self.applyPhysics = True
+        self.batchedPhysics = False
         
         self.falling = False
         self.jumping = False
@@ -366,13 +2676,15 @@ class MySprite(pygame.sprite.Sprite):
         self.walking = False
         self.horizontalFacing = self.FACE_RIGHT
         self.isDead = False
+        self.groundFriction = 1.0
+        self.setBodyType(self.BODY_TYPE)
        
     def __applyFlags(self):
         physics = self.scene.physics
         
         # If the sprite is falling, apply gravity and set 
         # walking, idle flags to false
-        if self.falling and self.applyPhysics:
+        if self.falling and self.applyPhysics and self.bodyType == self.BODY_DYNAMIC:
             self.addDY(physics.GRAVITY)
             self.walking = False
             self.idle = False
@@ -416,6 +2728,16 @@ class MySprite(pygame.sprite.Sprite):
         elif dySign > 0:
             self.jumping = False
         
+    def setBodyType(self, bodyType):
+        # Sets one of the BODY constants. Static bodies stop moving.
+        self.bodyType = bodyType
+        self.staticResolved = False
+        if bodyType == self.BODY_STATIC:
+            self.dx = 0
+            self.dy = 0
+            self.idle = True
+            self.walking = False
+            
     def hflip(self):
         # Flips the image of the sprite horizontally
         self.image = pygame.transform.flip(self.masterImage, True, False)
@@ -452,6 +2774,16 @@ class MySprite(pygame.sprite.Sprite):
         self.dx += amt
         self.__updateVector()
         
+    def walk(self, dx):
+        """ moves dx towards the given speed as fast as the
+            friction of the ground allows. On full friction
+            ground dx is set right away, on slippery ground
+            the sprite speeds up and slides to a stop """
+        if self.groundFriction >= 1:
+            self.setDX(dx)
+        else:
+            self.setDX(self.dx + (dx - self.dx) * self.groundFriction)
+        
     def setDY(self, dy):
         """ changes dy value and updates vector """
         self.dy = dy
@@ -497,40 +2829,89 @@ class MySprite(pygame.sprite.Sprite):
             signDY = cmp(int(self.dy), 0) * -1
             signDX = cmp(int(self.dx), 0) * -1
 
-            # Check left right collision
+            # Check left right collision. A side collided if the target's
+            # edge lies in the range of positions the side moved through.
             if signDX != 0:
-                        
-                for leftPosition in range(tempPosition[0], lastPosition[0] + 1, signDX):
-                    if leftPosition == targetRect.right:
-                        collisionList.append(self.COLLIDE_RIGHT)
-                        
-                for rightPosition in range(tempPosition[2], lastPosition[2] - 1, signDX):
-                    if rightPosition == targetRect.left:
-                        collisionList.append(self.COLLIDE_LEFT)
+                if self.__inRange(targetRect.right, tempPosition[0], lastPosition[0] + 1, signDX):
+                    collisionList.append(self.COLLIDE_RIGHT)
+                if self.__inRange(targetRect.left, tempPosition[2], lastPosition[2] - 1, signDX):
+                    collisionList.append(self.COLLIDE_LEFT)
                         
             # Check top bottom collision
-            if signDY != 0:               
-                        
-                for topPosition in range(tempPosition[1], lastPosition[1] + 1, signDY):
-                    if topPosition == targetRect.bottom:
-                        collisionList.append(self.COLLIDE_BOTTOM)
-
-                for bottomPosition in range(tempPosition[3], lastPosition[3] - 1, signDY):
-                    if bottomPosition == targetRect.top:
-                        collisionList.append(self.COLLIDE_TOP)
-
-
+            if signDY != 0:
+                if self.__inRange(targetRect.bottom, tempPosition[1], lastPosition[1] + 1, signDY):
+                    collisionList.append(self.COLLIDE_BOTTOM)
+                if self.__inRange(targetRect.top, tempPosition[3], lastPosition[3] - 1, signDY):
+                    collisionList.append(self.COLLIDE_TOP)
 
         return collisionList
     
+    def __inRange(self, value, start, stop, step):
+        # Same as value in range(start, stop, step) for a step of 1 or -1,
+        # without walking the range
+        if step > 0:
+            return start <= value < stop
+        return stop < value <= start
+    
     def update(self):
-        self.__applyFlags()
-        self.__calcPosition()
+        # Batched sprites are moved by the PhysicsBatch of their map
+        if self.bodyType == self.BODY_STATIC:
+            return
+        if not self.batchedPhysics:
+            self.__applyFlags()
+            self.__calcPosition()
 
     def doEvents(self, event):
         pass
     
 
+class EntitySprite(MySprite):
+    # Draws and collides an entity of a World like any other MySprite.
+    # Velocity, health and the animation image are taken from the entity
+    # every frame, and the SpriteSyncSystem copies the position back once
+    # the sprite has moved. Give the entity a position before creating it.
+    def __init__(self, scene, world, entity, image):
+        MySprite.__init__(self, scene, (0, 0))
+        self.world = world
+        self.entity = entity
+        self.masterImage = image
+        self.image = image
+        (centerx, centery) = world.getComponent(entity, World.POSITION)
+        self.rect = self.image.get_rect()
+        self.rect.center = (int(centerx), int(centery))
+        self.orginalCenter = self.rect.center
+        
+        world.addComponent(entity, World.SPRITE, self)
+        world.addComponent(entity, World.COLLIDER, self.rect.size)
+        if world.getComponent(entity, World.VELOCITY) == None:
+            world.addComponent(entity, World.VELOCITY, (0, 0))
+            
+    def update(self):
+        if not self.world.hasEntity(self.entity):
+            self.kill()
+            return
+        
+        (dx, dy) = self.world.getComponent(self.entity, World.VELOCITY)
+        if dx != self.dx:
+            self.setDX(dx)
+        if dy != self.dy:
+            self.setDY(dy)
+            
+        health = self.world.getComponent(self.entity, World.HEALTH)
+        if health != None:
+            self.health = health[0]
+        
+        animation = self.world.getComponent(self.entity, World.ANIMATION)
+        if animation != None:
+            self.image = animation.getImage()
+            
+        MySprite.update(self)
+        
+    def die(self):
+        self.kill()
+        self.world.destroyEntity(self.entity)
+    
+
 class MyFontSprite(pygame.sprite.Sprite):
     def __init__(self, scene, (center), (width, height), text, size = 16, color = (255, 255, 255)):
         pygame.sprite.Sprite.__init__(self)
@@ -545,7 +2926,7 @@ class MyFontSprite(pygame.sprite.Sprite):
         self.__renderImage()
         
     def __renderImage(self):
-        self.font = pygame.font.SysFont("None", self.size)
+        self.font = getFont("None", self.size)
         for index, line in enumerate(self.text):
             fontSize = self.font.size(line)
             self.fontImage = self.font.render(line, 1, self.color)                
@@ -658,6 +3039,14 @@ class SuperSprite(pygame.sprite.Sprite):
     HIDE = 3
     CONTINUE = 4
     
+    # Rotation Constants
+    # Rotated images are cached per image file in steps of
+    # ROTATION_STEP degrees. The cache is shared by every super sprite
+    # using the same file. Master images that were not loaded with 
+    # setImage are rotated without caching.
+    ROTATION_STEP = 5
+    ROTATION_CACHE = {}
+    
     def __init__(self, scene):
         pygame.sprite.Sprite.__init__(self)
         self.scene = scene
@@ -665,8 +3054,10 @@ class SuperSprite(pygame.sprite.Sprite):
         
         #create a default text image as a placeholder
         #This will usually be changed by a setImage call
+        initSubsystem(SUBSYSTEM_FONT)
         self.font = pygame.font.Font("freesansbold.ttf", 30)
         self.imageMaster = self.font.render(">sprite>", True, (0, 0,0), (0xFF, 0xFF, 0xFF))
+        self.imageFile = None
         self.image = self.imageMaster
         self.rect = self.image.get_rect()
         
@@ -684,6 +3075,9 @@ class SuperSprite(pygame.sprite.Sprite):
         self.boundAction = self.WRAP
         self.pressed = False
         self.oldCenter = (100, 100)
+        self.rotationStep = self.ROTATION_STEP
+        self.__lastRotation = None
+        self.__lastImageMaster = None
     
     def update(self):
         self.oldCenter = self.rect.center
@@ -706,11 +3100,51 @@ class SuperSprite(pygame.sprite.Sprite):
             change rotation property directly or with 
             rotateBy(), setAngle() methods
         """
+        # Quantize the rotation to the rotation step. If neither the
+        # quantized rotation nor the master image changed there is
+        # nothing to do.
+        rotation = int(round(self.rotation / float(self.rotationStep))) * self.rotationStep % 360
+        if rotation == self.__lastRotation and self.imageMaster is self.__lastImageMaster:
+            return
+        self.__lastRotation = rotation
+        self.__lastImageMaster = self.imageMaster
+        
         oldCenter = self.rect.center
         self.oldCenter = oldCenter
-        self.image = pygame.transform.rotate(self.imageMaster, self.rotation)
+        self.image = self.__getRotatedImage(rotation)
         self.rect = self.image.get_rect()
         self.rect.center = oldCenter
+        
+    def __getRotatedImage(self, rotation):
+        """ PRIVATE METHOD
+            returns the master image rotated by rotation
+            degrees. Rotated images are filled lazily into 
+            the shared rotation cache.
+        """
+        # Only images loaded from a file are cached, so the cache stays
+        # bounded by the number of image files
+        if self.imageFile == None or \
+           self.imageMaster is not loadImage(gameEngineUtil.DIR_GFX + self.imageFile):
+            return pygame.transform.rotate(self.imageMaster, rotation)
+        rotations = self.ROTATION_CACHE.get(self.imageFile)
+        if rotations == None:
+            rotations = {}
+            self.ROTATION_CACHE[self.imageFile] = rotations
+        key = (self.rotationStep, rotation)
+        image = rotations.get(key)
+        if image == None:
+            image = pygame.transform.rotate(self.imageMaster, rotation)
+            rotations[key] = image
+        return image
+        
+    def setRotationStep(self, step):
+        """ sets the angle step (in degrees) rotations
+            are quantized to. Smaller steps give smoother
+            rotation at the cost of more cached images.
+            Default value: 5
+        """
+        self.rotationStep = max(1, step)
+        self.__lastRotation = None
     
     def __calcVector(self):
         """ calculates dx and dy based on speed, dir
@@ -846,7 +3280,10 @@ class SuperSprite(pygame.sprite.Sprite):
         """ loads the given file name as the master image
             default setting should be facing east.  Image
             will be rotated automatically """
-        self.imageMaster = pygame.image.load(gameEngineUtil.DIR_GFX + image)
+        # Master images are shared between sprites loading the same
+        # file so they also share their cached rotations.
+        self.imageFile = image
+        self.imageMaster = loadImage(gameEngineUtil.DIR_GFX + image)
     
     def setDX(self, dx):
         """ changes dx value and updates vector """
@@ -1043,6 +3480,106 @@ class SuperSprite(pygame.sprite.Sprite):
     
 """ ------------------------------------------------------------------------------------------------------------------------ """
 
+""" Display
+    
+    All scenes share one display surface. The window is only created
+    when there is none yet or a different size or mode is asked for,
+    since switching into full screen mode can take a long time.
+    """
+def getSegmentEntry((startX, startY), (endX, endY), rect):
+    # Returns how far along the segment from start to end (0 to 1) it
+    # enters rect, or None if it misses it (Liang-Barsky clipping)
+    moveX = endX - startX
+    moveY = endY - startY
+    entry = 0.0
+    exit = 1.0
+    for (direction, distance) in ((-moveX, startX - rect.left), (moveX, rect.right - startX),
+                                  (-moveY, startY - rect.top), (moveY, rect.bottom - startY)):
+        if direction == 0:
+            if distance < 0:
+                return None
+        else:
+            time = distance / float(direction)
+            if direction < 0:
+                if time > exit:
+                    return None
+                entry = max(entry, time)
+            else:
+                if time < entry:
+                    return None
+                exit = min(exit, time)
+    return entry
+
+def getDisplay((width, height), flags = pygame.FULLSCREEN):
+    initSubsystem(SUBSYSTEM_DISPLAY)
+    if HEADLESS:
+        flags = 0
+    screen = pygame.display.get_surface()
+    if screen == None or screen.get_size() != (width, height) or \
+    screen.get_flags() & flags != flags:
+        screen = pygame.display.set_mode((width, height), flags)
+    return screen
+
+""" Scene Manager
+    
+    Owns the display and the scenes of a game. Scenes are registered
+    with a key and created the first time they are pushed. Warm scenes
+    are kept after they stop and reused the next time they are pushed,
+    so their maps and sprites are not loaded again.
+    """
+class SceneManager(object):
+    def __init__(self, (width, height), flags = pygame.FULLSCREEN):
+        self.size = (width, height)
+        self.screen = getDisplay(self.size, flags)
+        self.factories = {}
+        self.warmScenes = {}
+        self.stack = []
+        
+    #Registers a scene class. Extra arguments given to push are passed
+    #on to the scene's constructor after its size and title.
+    def register(self, key, sceneClass, title, keepWarm = False):
+        self.factories[key] = (sceneClass, title, keepWarm)
+        
+    #Returns the warm scene for key or creates a new one.
+    def getScene(self, key, *args):
+        if key in self.warmScenes:
+            return self.warmScenes[key]
+        (sceneClass, title, keepWarm) = self.factories[key]
+        scene = sceneClass(self.size, title, *args)
+        if keepWarm:
+            self.warmScenes[key] = scene
+        return scene
+    
+    #Pushes the scene for key on top of the scene stack.
+    def push(self, key, *args):
+        scene = self.getScene(key, *args)
+        self.stack.append(scene)
+        return scene
+    
+    #Pops the top scene off the scene stack.
+    def pop(self):
+        return self.stack.pop()
+    
+    #Replaces the top scene with the scene for key.
+    def replace(self, key, *args):
+        if self.stack:
+            self.stack.pop()
+        return self.push(key, *args)
+    
+    #Returns the scene on top of the stack.
+    def current(self):
+        if self.stack:
+            return self.stack[-1]
+        return None
+    
+    #Runs the top scene until it stops and returns it.
+    def run(self):
+        scene = self.current()
+        scene.setCaption(scene.title)
+        scene.start()
+        return scene
+    
+    
 """ Scene 
     
     Use this object creates a new python window in full screen mode and
@@ -1054,16 +3591,21 @@ class Scene(object):
     STOP_ANY_KEY = 0
     STOP_ESC = 1
     STOP_NEVER = -1
+    
+    # Event types let through by SDL. Event types subscribed to by the
+    # sprites of the scene are let through as well, all others are
+    # filtered out before they reach the event queue.
+    ALLOWED_EVENTS = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP)
     #Constructor for our scene object. Takes in width and height parameters which is
     #used for our display screen.  
     def __init__(self, (width, height), title):
-        #Initialize pygame and the screen in full screen mode with an black background.
-        pygame.init()
+        #Initialize the screen in full screen mode with an black background.
         self.width = width
         self.height = height
-        self.screen = pygame.display.set_mode((width, height), pygame.FULLSCREEN)
+        self.screen = getDisplay((width, height))
         self.background = pygame.Surface(self.screen.get_size())
         self.background.fill((0,0,0))
+        self.title = title
         self.setCaption(title)
         #Create our physics engine
         self.physics = Physics()
@@ -1077,6 +3619,11 @@ class Scene(object):
         self.keepGoing = True
         self.stopBound = self.STOP_ANY_KEY
         
+        self.eventRouter = EventRouter()
+        self.input = InputState()
+        self.recorder = None
+        self.replay = None
+        self.frameTimes = []
         self.clock = pygame.time.Clock()
         pygame.mouse.set_visible(False)
         
@@ -1084,9 +3631,18 @@ class Scene(object):
     def setStopBounds(self, bound):
         self.stopBound = bound
         
-    #Start the scene.
+    #Start the scene. Scenes can be started again after they stopped.
     def start(self):
+        self.keepGoing = True
+        self.exit = False
+        self.enter()
+        self.__setAllowedEvents()
         self.__mainLoop()
+        
+    #Called each time the scene is started. Override to start music or
+    #reset the state of a scene that is reused.
+    def enter(self):
+        pass
 
     #Stop our scene by getting out of the main loop.
     def stop(self):
@@ -1099,20 +3655,39 @@ class Scene(object):
         self.exit = True
         self.stop()
         
+    #Filters out the event types nobody in the scene handles.
+    def __setAllowedEvents(self):
+        allowedEvents = set(self.ALLOWED_EVENTS)
+        allowedEvents.update(self.eventRouter.getEventTypes())
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(list(allowedEvents))
+        
     #The main loop which executes the scene. The loop updates and renders the game and
     #calls doEvents automatically.
     def __mainLoop(self):
         
         while self.keepGoing:
-            keys = pygame.key.get_pressed()
             self.clock.tick(30)
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT or keys[pygame.K_ESCAPE]:
+            frameStart = time.time()
+            events = pygame.event.get()
+            if self.replay != None:
+                # Take the input from the replay. Quitting still works.
+                frame = self.replay.nextFrame()
+                if frame == None:
+                    self.stop()
+                    break
+                events = [event for event in events if event.type == pygame.QUIT] + frame[1]
+                self.input.feed(frame[0])
+            else:
+                self.input.capture()
+                if self.recorder != None:
+                    self.recorder.recordFrame(self.input.keys, events)
+                    
+            for event in events:
+                if event.type == pygame.QUIT or self.input.isPressed(pygame.K_ESCAPE):
                     self.terminate()
                 self.doEvents(event)
-                for group in self.groups:
-                    for sprite in group.sprites():
-                        sprite.doEvents(event)
+                self.eventRouter.dispatch(event)
                     
             self.update()
             for group in self.groups:
@@ -1124,10 +3699,31 @@ class Scene(object):
                 group.clear(self.screen, self.background)
                 group.draw(self.screen) 
             pygame.display.flip()
+            recordFirstFrame()
+            if self.replay != None:
+                self.frameTimes.append(time.time() - frameStart)
+            
+    #Records the input of every frame to recorder.
+    def setRecorder(self, recorder):
+        self.recorder = recorder
+        
+    #Plays the scene from a replay instead of the keyboard. The scene
+    #stops at the end of the replay. The time taken by each frame,
+    #without waiting for the frame rate, is kept in frameTimes.
+    def setReplay(self, replay):
+        self.replay = replay
+        self.frameTimes = []
             
     #Adds group to the scene. All groups will be updated and drawn in the main loop.
+    #Sprites of the group listing EVENT_TYPES are sent those events.
     def addGroup(self, group):
         self.groups.append(group)
+        self.eventRouter.subscribeGroup(group)
+        
+    #Sends the events listed in the sprite's EVENT_TYPES to its doEvents. Use this
+    #for sprites added to a group after the group was added to the scene.
+    def subscribeEvents(self, sprite):
+        self.eventRouter.subscribe(sprite)
 
     def addTopLayerGroup(self, group):
         self.topLayerGroup.append(group)
@@ -1135,11 +3731,10 @@ class Scene(object):
     #Processes any events issued and detected. It is automatically called in
     #the main loop.
     def doEvents(self, event):
-        keys = pygame.key.get_pressed()
         if event.type == pygame.KEYDOWN:
             if self.stopBound == self.STOP_ANY_KEY:
                 self.stop()
-            if self.stopBound == self.STOP_ESC and keys[pygame.K_ESCAPE]:
+            if self.stopBound == self.STOP_ESC and self.input.isPressed(pygame.K_ESCAPE):
                 self.stop()
         
     #Updates the scene. Is called automatically in the main loop.
@@ -1152,4 +3747,4 @@ class Scene(object):
         pygame.display.set_caption(title)
 
 
-                    
+recordStartupTime('import gameEngine', time.time() - __importStart)
@@ -4,15 +4,20 @@ Created on Aug 14, 2013
 @author: justin
 '''
 
-import pygame, gameEngine, random, math
+import pygame, gameEngine, math
 
 class BloodSplatter():
-    def __init__(self, scene, number, center):
-        bloodCount = 0
+    # Blood particles draw their random values from the tile map's
+    # random streams, in one batch for the whole splatter.
+    def __init__(self, scene, tileMap, number, center):
         self.bloods = []
-        while bloodCount < number:       
-            self.bloods.append(Blood(scene, center))     
-            bloodCount += 1
+        samples = tileMap.randomSamples(number * 3)
+        for bloodCount in range(number):
+            (delaySample, dirSample, speedSample) = samples[bloodCount * 3:bloodCount * 3 + 3]
+            killDelay = Blood.KILL_DELAY_MIN + int(delaySample * (Blood.KILL_DELAY_MAX - Blood.KILL_DELAY_MIN + 1))
+            direction = int(dirSample * 361)
+            speed = speedSample * Blood.SPEED_MAX
+            self.bloods.append(Blood(scene, center, killDelay, direction, speed))     
 
     def getBloodGroup(self):
         bloodGroup = pygame.sprite.Group()
@@ -24,16 +29,17 @@ class Blood(gameEngine.MySprite):
     KILL_DELAY_MIN = 200
     KILL_DELAY_MAX = 350
     SPEED_MAX = 15
-    def __init__(self, scene, center):
+    CAN_SLEEP = False
+    def __init__(self, scene, center, killDelay, direction, speed):
         gameEngine.MySprite.__init__(self, scene, center, "")
         self.image = pygame.surface.Surface((2,2))
         self.image.fill((255,0,0))
         self.rect = self.image.get_rect()
         self.rect.center = center
-        self.killDelay = random.randint(self.KILL_DELAY_MIN, self.KILL_DELAY_MAX)
+        self.killDelay = killDelay
         self.killCounter = 0
-        self.dir = random.randint(0, 360)
-        self.speed = random.random() * self.SPEED_MAX
+        self.dir = direction
+        self.speed = speed
         
         theta = self.dir / 180.0 * math.pi
         self.dx = math.cos(theta) * self.speed
@@ -16,7 +16,7 @@
 import pygame, pygame.gfxdraw, copy
 
 class DrawBar(pygame.sprite.Sprite):
-    NUM_OF_TILES = 20
+    NUM_OF_TILES = 27
     TILES_PER_ROW = 12
     def __init__(self, surface, tilesize = 16):
         pygame.sprite.Sprite.__init__(self)
@@ -375,6 +375,10 @@ class TileMap(pygame.sprite.Sprite):
                             self.entities.append([info[0], self.scrollx + mousePos[0] - self.rect.left, 
                                                   self.scrolly + mousePos[1] - self.rect.top])
                             self.__redraw()
+                        if info[1] == pygame.key.name(pygame.K_h) and keys[pygame.K_h]:
+                            self.entities.append([info[0], self.scrollx + mousePos[0] - self.rect.left, 
+                                                  self.scrolly + mousePos[1] - self.rect.top])
+                            self.__redraw()
                                                         
                 else:          
                     #Toggle grid visibility
@@ -466,7 +470,9 @@ def __render(screen, tileMap):
     
                     
 def main():
-    pygame.init()
+    #The level maker only needs the display and fonts
+    pygame.display.init()
+    pygame.font.init()
     
     screen = pygame.display.set_mode((800, 600))
     pygame.display.set_caption("Level Maker - Ritz")
@@ -11,11 +11,14 @@ class Door(gameEngine.MyBasicSprite):
         gameEngine.MyBasicSprite.__init__(self, center, pygame.image.load("gfx/misc/door.png"))
         self.ritzMap = ritzMap
         self.enter = False
+        
+    def reset(self):
+        self.enter = False
 
     def update(self):
-        keys = pygame.key.get_pressed()
         self.ritzSprite = self.ritzMap.ritzSprite
-        if pygame.rect.Rect.colliderect(self.rect, self.ritzSprite.rect) and keys[pygame.K_s]:
+        if pygame.rect.Rect.colliderect(self.rect, self.ritzSprite.rect) and \
+        self.ritzMap.scene.input.isPressed(pygame.K_s):
             self.enter = True
 
 class LevelDoor(Door):
@@ -62,57 +65,49 @@ class ExitSceneDoor(Door):
 class Coin(gameEngine.MySprite):
     IDLE_IMG_MAX = 8
     POINTS = 25
+    BODY_TYPE = gameEngine.MySprite.BODY_STATIC
     def __init__(self, scene, ritzTileMap, center):
         gameEngine.MySprite.__init__(self, scene, center, "misc/coin0.png")
         self.idleImages = []
         self.ritzTileMap = ritzTileMap
         
-        self.animationCounter = 0
-        self.animationDelay = 1
-        self.delayCounter = 0
+        self.animationDelay = 2
         self.center = center
-        self.applyPhysics = False
+        self.entity = None
         
         self.__loadImages()
         self.__loadSounds()
+        self.__adopt()
         
     def __loadImages(self):
         # Add idle images
         for i in range(self.IDLE_IMG_MAX):
-            self.idleImages.append(pygame.image.load("gfx/misc/coin{0}.png".format(i)))
+            self.idleImages.append(gameEngine.loadImage("gfx/misc/coin{0}.png".format(i)))
 
     def __loadSounds(self):
-        self.sndCoin = pygame.mixer.Sound("sfx/coin.ogg")
+        self.sndCoin = gameEngine.loadSound("sfx/coin.ogg")
+        
+    def __adopt(self):
+        # The coin is mirrored in the map's World, whose AnimationSystem
+        # spins it. Its entity is released when the coin is collected 
+        # and adopted again if a rewind brings the coin back.
+        world = self.ritzTileMap.world
+        self.entity = world.adoptSprite(self)
+        world.addComponent(self.entity, gameEngine.World.ANIMATION, 
+                           gameEngine.Animation(self.idleImages, self.animationDelay))
         
     def __handleAnimation(self):
-        if self.delayCounter < self.animationDelay:
-            self.delayCounter += 1
-        else:
-            maxImg = 0
-            animationImages = []
-            self.delayCounter = 0
-            
-            if self.idle:
-                maxImg = self.IDLE_IMG_MAX
-                animationImages = self.idleImages
-            else:
-                #Use idle as default if none of these attributes are set.
-                #Just in case, you should also have one of these flags set.
-                maxImg = self.IDLE_IMG_MAX
-                animationImages = self.idleImages
-                
-            if self.animationCounter >=  maxImg:
-                self.animationCounter = 0
-                self.masterImage = animationImages[maxImg - 1]
-            else:
-                self.masterImage = animationImages[self.animationCounter]
-                self.animationCounter += 1
-   
+        animation = self.ritzTileMap.world.getComponent(self.entity, gameEngine.World.ANIMATION)
+        image = animation.getImage()
+        if image is not self.masterImage:
+            self.masterImage = image
             self.image = self.masterImage
             self.rect = self.image.get_rect()
             self.rect.center = self.orginalCenter
             
     def update(self):
+        if self.entity == None:
+            self.__adopt()
         gameEngine.MySprite.update(self)
         self.__handleAnimation()
         
@@ -127,7 +122,7 @@ class ScoreBoard(pygame.sprite.Sprite):
         self.__renderImage()
 
     def __renderImage(self):
-        self.font = pygame.font.SysFont("None", 32)
+        self.font = gameEngine.getFont("None", 32)
         self.image = self.font.render("Score: {0}".format(self.score), 1, (255, 255, 255))
         self.rect = self.image.get_rect()
         self.rect.center = self.center
@@ -139,6 +134,11 @@ class ScoreBoard(pygame.sprite.Sprite):
     def getScore(self):
         return self.score
     
+    def setScore(self, score):
+        if score != self.score:
+            self.score = score
+            self.__renderImage()
+    
         
     def doEvents(self, event):
         pass
@@ -176,6 +176,14 @@ class LifeCounter(pygame.sprite.Sprite):
             self.scene.stop()
         else:
             self.__renderImage()
+            
+    def getLives(self):
+        return self.lives
+    
+    def setLives(self, lives):
+        if lives != self.lives:
+            self.lives = lives
+            self.__renderImage()
         
     def doEvents(self, event):
         pass
@@ -191,7 +199,7 @@ class GraveStone(gameEngine.MyBasicSprite):
         """
             Render font
         """
-        self.font = pygame.font.SysFont(self.FONT_NAME, self.FONT_SIZE, self.FONT_WEIGHT, self.FONT_ITALIC)
+        self.font = gameEngine.getFont(self.FONT_NAME, self.FONT_SIZE, self.FONT_WEIGHT, self.FONT_ITALIC)
         self.fontImage = self.font.render("RIP", True, self.FONT_COLOR)
         fontSize = self.font.size("RIP")
         self.image.blit(self.fontImage, (self.rect.width / 2 - fontSize[0] / 2, 
@@ -220,7 +228,7 @@ class ButtonSprite(gameEngine.MyBasicSprite):
         """
             Render font
         """
-        self.font = pygame.font.SysFont(self.FONT_NAME, self.FONT_SIZE, self.FONT_WEIGHT, self.FONT_ITALIC)
+        self.font = gameEngine.getFont(self.FONT_NAME, self.FONT_SIZE, self.FONT_WEIGHT, self.FONT_ITALIC)
         self.fontImage = self.font.render(text, True, self.FONT_COLOR)
         fontSize = self.font.size(text)
         self.image.blit(self.fontImage, (self.rect.width / 2 - fontSize[0] / 2, 
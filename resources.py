@@ -4,7 +4,7 @@ Created on Aug 8, 2013
 @author: Justin Hellsten
 '''
 
-import pygame
+import pygame, gameEngine
 
 DATA_DIRECTORY = "data/"
 MFX_DIRECTORY = "mfx/"
@@ -35,24 +35,45 @@ PLAY_TEXT = ("Play", "")
 EXIT_TEXT = ("Exit", "")
 GAME_OVER_TEXT = ("Game Over", "")
 
+#Loads the shared sounds and graphics. pygame subsystems are
+#initialized lazily by the game engine, the mixer is skipped in
+#headless runs.
 def init():
-    pygame.init()
+    global collectCoin, bulletCollision, ritzJump, ritzShoot, DOOR_IMAGE
     
-    if pygame.mixer.get_init != None:  
-        collectCoin = pygame.mixer.Sound("sfx/coin.ogg")
-        bulletCollision = pygame.mixer.Sound("sfx/bullet_hit.ogg")
-        ritzJump = pygame.mixer.Sound("sfx/ritz_jump.ogg")
-        ritzShoot = pygame.mixer.Sound("sfx/ritz_bullet.ogg")
+    collectCoin = gameEngine.loadSound("sfx/coin.ogg")
+    bulletCollision = gameEngine.loadSound("sfx/bullet_hit.ogg")
+    ritzJump = gameEngine.loadSound("sfx/ritz_jump.ogg")
+    ritzShoot = gameEngine.loadSound("sfx/ritz_bullet.ogg")
 
     DOOR_IMAGE = pygame.image.load("gfx/misc/door.png")
     
-#Loads and plays a music theme
+#Music currently loaded in the mixer
+currentMusic = None
+
+#Loads and plays a music theme. If the theme is already playing
+#only the volume is changed.
 def playMusic(music = None, loops = -1, volume = 1.0):
+    global currentMusic
+    if not gameEngine.initSubsystem(gameEngine.SUBSYSTEM_MIXER):
+        return
     if music == None:
         pygame.mixer.music.set_volume(0)
     else:
         pygame.mixer.music.set_volume(volume)
+        if music == currentMusic and pygame.mixer.music.get_busy():
+            return
         pygame.mixer.music.load(music)
-        pygame.mixer.music.play(loops)    
-    
-        
\ No newline at end of file
+        pygame.mixer.music.play(loops)
+        currentMusic = music
+        
+#Stops the music theme
+def stopMusic():
+    if gameEngine.initSubsystem(gameEngine.SUBSYSTEM_MIXER):
+        pygame.mixer.music.stop()
+        
+#Plays the current music theme again from the start
+def restartMusic():
+    if gameEngine.initSubsystem(gameEngine.SUBSYSTEM_MIXER):
+        pygame.mixer.music.rewind()
+        pygame.mixer.music.play()
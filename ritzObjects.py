@@ -4,7 +4,7 @@ Created on Aug 15, 2013
 @author: justin
 '''
 
-import pygame, resources, miscellaneous, enemies, gameEngine, graphics
+import pygame, zlib, collections, resources, miscellaneous, enemies, gameEngine, graphics
 
 
 class RitzBullet(gameEngine.MySprite):
@@ -13,6 +13,11 @@ class RitzBullet(gameEngine.MySprite):
     FADE_DELAY = 250
     DAMAGE = 10
     POINTS = 10
+    CAN_SLEEP = False
+    """
+        Bullets sweep their path every frame, so they move themselves
+    """
+    CAN_BATCH = False
     
     def __init__(self, scene, ritzTileMap, scoreBoard, facing, center):
         gameEngine.MySprite.__init__(self, scene, center, "ritzbullet.png")
@@ -26,7 +31,7 @@ class RitzBullet(gameEngine.MySprite):
         if self.facing == self.FACE_RIGHT:
             self.setDX(self.SPEED)
             
-        self.sndCollision = pygame.mixer.Sound("sfx/bullet_hit.ogg")
+        self.sndCollision = gameEngine.loadSound("sfx/bullet_hit.ogg", 0.5)
 
         
     def __checkFadeStatus(self):
@@ -35,20 +40,107 @@ class RitzBullet(gameEngine.MySprite):
         else:
             self.kill()
             
+    def __hitEnemy(self, enemy):
+        enemy.deductHealth(self.DAMAGE)
+        self.sndCollision.play()
+        if self.scoreBoard != None:
+            self.scoreBoard.addScore(self.POINTS)
+        self.kill()
+            
     def __AI(self):
         enemiesHit = pygame.sprite.spritecollide(self, self.ritzTileMap.enemiesGroup, False)
         for enemy in enemiesHit:
             if self.speed != 0:
-                enemy.deductHealth(self.DAMAGE)
-                self.sndCollision.set_volume(0.5)
-                self.sndCollision.play()
-                if self.scoreBoard != None:
-                    self.scoreBoard.addScore(self.POINTS)
-                self.kill()
+                self.__hitEnemy(enemy)
+                
+    def __sweep(self, start):
+        """
+            Checks the path from start to the current position against
+            the tiles and the enemies, so fast bullets can't pass through
+            them. The bullet stops at whatever it reaches first.
+        """
+        end = self.rect.center
+        (moveX, moveY) = (end[0] - start[0], end[1] - start[1])
+        if moveX == 0 and moveY == 0:
+            return
+        pathRect = self.rect.union(self.rect.move(-moveX, -moveY))
+        
+        wallHit = self.__sweepWalls(start, end, pathRect)
+        wallTime = 1.0
+        if wallHit != None:
+            wallTime = wallHit[0]
+            
+        enemyHit = None
+        enemyTime = wallTime
+        for enemy in self.ritzTileMap.getSpriteIndex(self.ritzTileMap.enemiesGroup).query(pathRect):
+            time = gameEngine.getSegmentEntry(start, end, enemy.rect.inflate(self.rect.width, self.rect.height))
+            if time != None and time <= enemyTime and enemy.alive():
+                enemyHit = enemy
+                enemyTime = time
+                
+        if enemyHit != None:
+            self.rect.center = (int(start[0] + moveX * enemyTime), int(start[1] + moveY * enemyTime))
+            self.__hitEnemy(enemyHit)
+        elif wallHit != None:
+            self.__stopAtWall(wallHit, start, moveX, moveY)
+            
+    def __sweepWalls(self, start, end, pathRect):
+        """
+            Returns (time, ix, iy) of the first block tile the bullet 
+            runs into on its path, or None. Like enemies, the tiles are
+            inflated by the bullet size so the whole bullet is swept,
+            not just its center.
+        """
+        tileMap = self.ritzTileMap
+        tilesize = tileMap.tilesize
+        tileProperties = tileMap.getTileProperties()
+        (indexWidth, indexHeight) = tileMap.getIndexSize()
+        hit = None
+        for iy in xrange(max(pathRect.top // tilesize, 0), min((pathRect.bottom - 1) // tilesize + 1, indexHeight)):
+            for ix in xrange(max(pathRect.left // tilesize, 0), min((pathRect.right - 1) // tilesize + 1, indexWidth)):
+                if not tileProperties.isBlock(tileMap.tiles[iy][ix]):
+                    continue
+                tileRect = pygame.rect.Rect(ix * tilesize, iy * tilesize, tilesize, tilesize)
+                time = gameEngine.getSegmentEntry(start, end, tileRect.inflate(self.rect.width, self.rect.height))
+                if time != None and (hit == None or time < hit[0]):
+                    hit = (time, ix, iy)
+        return hit
+            
+    def __stopAtWall(self, (time, ix, iy), start, moveX, moveY):
+        """
+            Puts the bullet against the side of the tile it hit and stops
+            it the way tile collisions do
+        """
+        tilesize = self.ritzTileMap.tilesize
+        hitX = start[0] + moveX * time
+        hitY = start[1] + moveY * time
+        tileRect = pygame.rect.Rect(ix * tilesize, iy * tilesize, tilesize, tilesize)
+        swept = tileRect.inflate(self.rect.width, self.rect.height)
+        onSide = moveX != 0 and (abs(hitX - swept.left) < 0.001 or abs(hitX - swept.right) < 0.001)
+        if onSide:
+            if moveX > 0:
+                self.rect.right = ix * tilesize
+            else:
+                self.rect.left = (ix + 1) * tilesize
+            self.rect.centery = int(hitY)
+            self.setDX(0)
+        else:
+            if moveY > 0:
+                self.rect.bottom = iy * tilesize
+                self.setDX(0)
+                self.setDY(0)
+                self.falling = False
+            else:
+                self.rect.top = (iy + 1) * tilesize
+                self.setDY(0)
+            self.rect.centerx = int(hitX)
       
     def update(self):
+        start = self.rect.center
         gameEngine.MySprite.update(self)
-        self.__AI()
+        self.__sweep(start)
+        if self.alive():
+            self.__AI()
         self.__checkFadeStatus()
         
 
@@ -61,6 +153,9 @@ class Ritz(gameEngine.MySprite):
     WALK_SPEED = 5
     JUMP_SPEED = -10
     
+    EVENT_TYPES = (pygame.KEYDOWN,)
+    CAN_SLEEP = False
+    
     def __init__(self, scene, ritzTileMap, scoreBoard, center):
         gameEngine.MySprite.__init__(self, scene, center, "ritz/idle0.png")
 
@@ -85,27 +180,24 @@ class Ritz(gameEngine.MySprite):
     def __loadImages(self):
         # Add idle images
         for i in range(self.IDLE_IMG_MAX):
-            self.idleImages.append(pygame.image.load("gfx/ritz/idle{0}.png".format(i)))
+            self.idleImages.append(gameEngine.loadImage("gfx/ritz/idle{0}.png".format(i)))
         
         # Add Walk images
         for i in range(self.WALK_IMG_MAX):
-            self.walkImages.append(pygame.image.load("gfx/ritz/walk{0}.png".format(i)))
+            self.walkImages.append(gameEngine.loadImage("gfx/ritz/walk{0}.png".format(i)))
         
         # Add Falling images
         for i in range(self.FALLING_IMG_MAX):
-            self.fallingImages.append(pygame.image.load("gfx/ritz/falling{0}.png".format(i)))
+            self.fallingImages.append(gameEngine.loadImage("gfx/ritz/falling{0}.png".format(i)))
                
         # Add Jumping images
         for i in range(self.JUMPING_IMG_MAX):
-            self.jumpingImages.append(pygame.image.load("gfx/ritz/jumping{0}.png".format(i)))
+            self.jumpingImages.append(gameEngine.loadImage("gfx/ritz/jumping{0}.png".format(i)))
                
     def __loadSounds(self):
-        self.sndJump = pygame.mixer.Sound("sfx/ritz_jump.ogg")
-        self.sndShoot = pygame.mixer.Sound("sfx/ritz_bullet.ogg")
-        self.sndDeath = pygame.mixer.Sound("sfx/death.ogg")
-        self.sndJump.set_volume(0.05)
-        self.sndShoot.set_volume(0.1)
-        self.sndDeath.set_volume(0.3)
+        self.sndJump = gameEngine.loadSound("sfx/ritz_jump.ogg", 0.05)
+        self.sndShoot = gameEngine.loadSound("sfx/ritz_bullet.ogg", 0.1)
+        self.sndDeath = gameEngine.loadSound("sfx/death.ogg", 0.3)
         
     def __handleAnimation(self):
         if self.delayCounter < self.animationDelay:
@@ -140,25 +232,24 @@ class Ritz(gameEngine.MySprite):
             
             
     def __handleFalling(self):
-        keys = pygame.key.get_pressed()
-
         if self.falling:
             self.onGround = False
         else:
             self.onGround = True
             
-        if keys[pygame.K_w] and self.onGround:
+        if self.scene.input.isPressed(pygame.K_w) and self.onGround:
             self.setDY(self.JUMP_SPEED)
             self.sndJump.play()
             
     def __handleWalking(self):
-        keys = pygame.key.get_pressed()
-        self.setDX(0)
+        keys = self.scene.input
+        speed = 0
         
-        if keys[pygame.K_a]:
-            self.setDX(-self.WALK_SPEED)
-        if keys[pygame.K_d]: 
-            self.setDX(self.WALK_SPEED)
+        if keys.isPressed(pygame.K_a):
+            speed = -self.WALK_SPEED
+        if keys.isPressed(pygame.K_d): 
+            speed = self.WALK_SPEED
+        self.walk(speed)
 
         if self.horizontalFacing == self.FACE_LEFT:
             self.hflip()  
@@ -171,9 +262,9 @@ class Ritz(gameEngine.MySprite):
             coin.kill()
             
     def die(self):
-        pygame.mixer.music.stop()
+        resources.stopMusic()
         self.sndDeath.play()
-        bloodSplatter = graphics.BloodSplatter(self.scene, 50, self.rect.center)
+        bloodSplatter = graphics.BloodSplatter(self.scene, self.ritzTileMap, 50, self.rect.center)
         self.ritzTileMap.addGroup(bloodSplatter.getBloodGroup())
         self.kill()
             
@@ -186,9 +277,8 @@ class Ritz(gameEngine.MySprite):
         
     def doEvents(self, event):
         gameEngine.MySprite.doEvents(self, event)
-        keys = pygame.key.get_pressed()
         if event.type == pygame.KEYDOWN:
-            if keys[pygame.K_SPACE]:
+            if self.scene.input.isPressed(pygame.K_SPACE):
                 self.ritzTileMap.addSprite(RitzBullet(self.scene, self.ritzTileMap, self.scoreBoard,
                                                       self.horizontalFacing, (self.rect.center)))
                 self.sndShoot.play()
@@ -200,10 +290,17 @@ class RitzLevelLoader():
     MAP_IMGDIR = '[imgdir]'
     MAP_STARTLOCATION = '[startlocation]'
     MAP_ENTITIES = '[entities]'
-    MAP_SECTIONS = [MAP_TOKENS, MAP_SIZE, MAP_IMG, MAP_IMGDIR, MAP_STARTLOCATION, MAP_ENTITIES]
+    MAP_TILEPROPS = '[tileprops]'
+    MAP_SECTIONS = [MAP_TOKENS, MAP_SIZE, MAP_IMG, MAP_IMGDIR, MAP_STARTLOCATION, MAP_ENTITIES, MAP_TILEPROPS]
+    """
+        Tile properties file in the tile directory, used when a level
+        has no [tileprops] section
+    """
+    DEFAULT_TILEPROPS = 'tiles.cfg'
     def __init__(self, datafile):
         f = open(resources.DATA_DIRECTORY + datafile)
-        self.data = {'[tokens]':[], '[size]':0, '[imgs]':[], '[imgdir]':'', '[startlocation]':(0,0), '[entities]':[(0,0,0)]} 
+        self.data = {'[tokens]':[], '[size]':0, '[imgs]':[], '[imgdir]':'', '[startlocation]':(0,0), '[entities]':[(0,0,0)],
+                     '[tileprops]':self.DEFAULT_TILEPROPS} 
         reading = ""
         
         for line in f.readlines():
@@ -232,6 +329,8 @@ class RitzLevelLoader():
             elif reading == self.MAP_ENTITIES:
                 tokens = line.split(',')
                 self.data[self.MAP_ENTITIES].append([tokens[0], int(tokens[1]), int(tokens[2])])
+            elif reading == self.MAP_TILEPROPS:
+                self.data[self.MAP_TILEPROPS] = line
                 
         f.close()
         
@@ -247,6 +346,9 @@ class RitzLevelLoader():
     def getTileImages(self):
         return self.data[self.MAP_IMG]
     
+    def getTileProperties(self):
+        return self.getTileDirectory() + self.data[self.MAP_TILEPROPS]
+    
     def getStartLocation(self):
         return self.data[self.MAP_STARTLOCATION]
     
@@ -254,47 +356,109 @@ class RitzLevelLoader():
         return self.data[self.MAP_ENTITIES]
 
 class RitzTileMap(gameEngine.TileMap):
-    TRANPARENT_TILE = 0
-    SPIKE_TILE = 20
+    """
+        Entities further than this outside the screen are asleep
+    """
+    ACTIVATION_MARGIN = 200
+    """
+        Entities are only created once they come this close to the
+        screen, and put away again once they are further than the
+        despawn margin
+    """
+    STREAM_SPAWN_MARGIN = 300
+    STREAM_DESPAWN_MARGIN = 500
     def __init__(self, scene, datafile, noRitz = False): 
         gameEngine.TileMap.__init__(self, scene)
         """
             Misc. Init
         """
         self.setBoundary(True, True, True, False)
+        
+        """
+            Every level gets its own random streams, derived from
+            the game seed and the level's data file
+        """
+        self.setSeed((gameEngine.getSeed() ^ zlib.crc32(datafile)) & 0xFFFFFFFF)
 
         """
             Load and pass data file information
         """
         self.ritzLevelLoader = RitzLevelLoader(datafile)
         self.loadTileImages(self.ritzLevelLoader.getTileDirectory(), self.ritzLevelLoader.getTileImages())
+        self.loadTileProperties(self.ritzLevelLoader.getTileProperties())
         self.setTileSize(self.ritzLevelLoader.getTileSize())
         self.setTiles(self.ritzLevelLoader.getTokens())
+        self.getTileTables()
+        self.getNavigationMap()
 
         """
             Load and add entities
         """
         self.ritzSprite = Ritz(self.scene, self, None, self.ritzLevelLoader.getStartLocation())
+        self.ritzGroup = pygame.sprite.Group()
         self.enemiesGroup = pygame.sprite.Group()
         self.miscGroup = pygame.sprite.Group()
 
+        hasChasers = False
         for data in self.ritzLevelLoader.getEntityInfo():
             if data[0] == 'goomba':
-                self.enemiesGroup.add(enemies.Goomba(self.scene, self, (data[1], data[2])))
+                self.addSpawnRecord(enemies.Goomba, self.enemiesGroup, (data[1], data[2]))
             elif data[0] == 'coin':
-                self.miscGroup.add(miscellaneous.Coin(self.scene, self, (data[1], data[2])))
+                self.addSpawnRecord(miscellaneous.Coin, self.miscGroup, (data[1], data[2]))
             elif data[0] == 'shyguy':
-                self.enemiesGroup.add(enemies.ShyGuy(self.scene, self, (data[1], data[2])))
+                self.addSpawnRecord(enemies.ShyGuy, self.enemiesGroup, (data[1], data[2]))
+            elif data[0] == 'chaser':
+                self.addSpawnRecord(enemies.Chaser, self.enemiesGroup, (data[1], data[2]))
+                hasChasers = True
             elif data[0] == 'door':
                 self.addStaticGroup(pygame.sprite.Group(miscellaneous.LevelDoor(self.scene, self, (data[1], data[2]))))
              
+        """
+            Chasers share one navigation graph per level. It is built
+            with the level so the first chaser does not stall the game
+        """
+        if hasChasers:
+            self.getNavigationGraph(enemies.Chaser.JUMP_SPEED, enemies.Chaser.WALK_SPEED)
+             
         if not noRitz:
-            self.addSprite(self.ritzSprite)   
+            self.addEntity(self.ritzSprite, self.ritzGroup)
+            self.addGroup(self.ritzGroup)
         self.addGroup(self.enemiesGroup)
         self.addGroup(self.miscGroup)
         
+        """
+            Enemies run their patrol AI in batches when numpy is available
+        """
+        self.world.addSystem(enemies.PatrolSystem(self, self.enemiesGroup, enemies.ShyGuy))
+        self.world.addSystem(enemies.PatrolSystem(self, self.enemiesGroup, enemies.Goomba))
+        
+        """
+            Ritz's state at the start location, restored on respawn
+        """
+        self.spawnSnapshot = self.snapshot([self.ritzSprite], False)
+        self.checkpoint = None
+        
+    def saveCheckpoint(self):
+        """
+            Saves the state of every entity in the level
+        """
+        self.checkpoint = self.snapshot()
+        
+    def loadCheckpoint(self):
+        """
+            Puts every entity back to the last saved checkpoint
+        """
+        if self.checkpoint != None:
+            self.restore(self.checkpoint)
+        
 class RitzMap(RitzTileMap):
     DEATH_DELAY = 100
+    """
+        Hold REWIND_KEY to play the level backwards, up to
+        REWIND_FRAMES frames (10 seconds at 30 frames per second)
+    """
+    REWIND_KEY = pygame.K_r
+    REWIND_FRAMES = 300
     def __init__(self, scene, datafile):
         RitzTileMap.__init__(self, scene, datafile)
         """
@@ -302,10 +466,68 @@ class RitzMap(RitzTileMap):
         """
         self.playDeathTheme = False
         self.deathDelayCounter = 0
+        self.rewindBuffer = gameEngine.RewindBuffer(self, self.entities, self.REWIND_FRAMES)
+        self.rewindProgress = collections.deque(maxlen = self.REWIND_FRAMES)
+        self.lastProgress = None
               
     def update(self):
-        RitzTileMap.update(self)
-        self.__handleDeaths()
+        if self.scene.input.isPressed(self.REWIND_KEY):
+            self.__rewind()
+        else:
+            RitzTileMap.update(self)
+            self.__handleDeaths()
+            self.__recordFrame()
+        self.centerOnRitz()
+        
+    def getProgress(self):
+        """
+            Values the rewind buffer does not record, like the score.
+            Override to return them and setProgress to restore them.
+        """
+        return None
+    
+    def setProgress(self, progress):
+        pass
+        
+    def __recordFrame(self):
+        """
+            Records the frame for rewinding, along with the progress
+            from before it so rewinding gives back score and lives too.
+        """
+        self.rewindBuffer.record()
+        self.rewindProgress.append(self.lastProgress)
+        self.lastProgress = self.getProgress()
+        
+    def __rewind(self):
+        """
+            Steps the entities one frame back. Bullets and blood
+            are not rewound, they wait until the rewind is over.
+        """
+        wasAlive = self.ritzSprite.alive()
+        if self.rewindBuffer.rewind():
+            self.lastProgress = self.rewindProgress.pop()
+            self.setProgress(self.lastProgress)
+        if self.ritzSprite.alive():
+            self.deathDelayCounter = 0
+            if not wasAlive:
+                resources.restartMusic()
+        self.render()
+        
+    def __clearRewind(self):
+        self.rewindBuffer.clear()
+        self.rewindProgress.clear()
+        self.lastProgress = self.getProgress()
+        
+    def respawnRitz(self):
+        """
+            Moves ritz back to the start location
+        """
+        self.restore(self.spawnSnapshot)
+        self.__clearRewind()
+        self.deathDelayCounter = 0
+        self.centerOnRitz()
+        
+    def centerOnRitz(self):
         """
             Bound scroll to ritz's position
         """
@@ -313,10 +535,9 @@ class RitzMap(RitzTileMap):
                                self.ritzSprite.rect.centery - self.screen.get_height() / 2)
                 
     def reset(self):
-        pygame.mixer.music.rewind()
-        pygame.mixer.music.play()
-        self.ritzSprite = Ritz(self.scene, self, None, self.ritzLevelLoader.getStartLocation())
-        self.addSprite(self.ritzSprite) 
+        resources.restartMusic()
+        self.restore(self.spawnSnapshot)
+        self.__clearRewind()
         self.playDeathTheme = False 
 
         
@@ -341,11 +562,27 @@ class RitzLevel(RitzMap):
         self.livesBoard = miscellaneous.LifeCounter(scene, (50,40), self.ritzSprite)
  
         self.topLayerGroup = pygame.sprite.Group(self.scoreBoard, self.livesBoard)
-        self.scene.addTopLayerGroup(self.topLayerGroup)
         self.ritzSprite.scoreBoard = self.scoreBoard
+        self.lastProgress = self.getProgress()
+        
+    def activate(self):
+        """
+            Called when the level becomes the scene's current level.
+            Levels may be built ahead of time on a loader thread so
+            anything touching the scene is done here.
+        """
+        self.scene.addTopLayerGroup(self.topLayerGroup)
+        
+    def getProgress(self):
+        return (self.scoreBoard.getScore(), self.livesBoard.getLives())
+    
+    def setProgress(self, progress):
+        (score, lives) = progress
+        self.scoreBoard.setScore(score)
+        self.livesBoard.setLives(lives)
         
     def reset(self):
-        RitzMap.reset(self)
         self.livesBoard.removeLife()
+        RitzMap.reset(self)
         self.ritzSprite.scoreBoard = self.scoreBoard
                            
@@ -37,9 +37,12 @@
     -> Game over scene shows score and there is a grave stone sprite
     
 """
-import pygame, gameEngine, random, ritzObjects
+import time
+importStart = time.time()
+import sys, pygame, gameEngine, random, ritzObjects
 import enemies, graphics, miscellaneous
 import resources
+gameEngine.recordStartupTime("import game modules", time.time() - importStart)
 
 """ Scene Constants """
 SCENE_SPLASH = 0
@@ -63,28 +66,41 @@ class LevelOne(ritzObjects.RitzLevel):
    
     def __init__(self, scene): 
         ritzObjects.RitzLevel.__init__(self, scene, "level1.dat")
+        
+    def activate(self):
+        ritzObjects.RitzLevel.activate(self)
         resources.playMusic(resources.MFX_LEVEL_ONE_THEME, -1, 0.3)
 
 class LevelTwo(ritzObjects.RitzLevel):
    
     def __init__(self, scene): 
         ritzObjects.RitzLevel.__init__(self, scene, "level2.dat")
+        
+    def activate(self):
+        ritzObjects.RitzLevel.activate(self)
         resources.playMusic(resources.MFX_LEVEL_ONE_THEME, -1, 0.3)
         
 class LevelThree(ritzObjects.RitzLevel):
    
     def __init__(self, scene): 
         ritzObjects.RitzLevel.__init__(self, scene, "level3.dat")
+        
+    def activate(self):
+        ritzObjects.RitzLevel.activate(self)
         resources.playMusic(resources.MFX_LEVEL_ONE_THEME, -1, 0.3)
                 
 class LevelFour(ritzObjects.RitzLevel):
  
     def __init__(self, scene): 
         ritzObjects.RitzLevel.__init__(self, scene, "level4.dat")
+        
+    def activate(self):
+        ritzObjects.RitzLevel.activate(self)
         resources.playMusic(resources.MFX_LEVEL_ONE_THEME, -1, 0.3)
   
 
 class GamePlayScene(gameEngine.Scene):
+    LEVELS = {1: LevelOne, 2: LevelTwo, 3: LevelThree, 4: LevelFour}
     def __init__(self, (width, height), title):
         gameEngine.Scene.__init__(self, (width, height), title)
           
@@ -96,12 +112,38 @@ class GamePlayScene(gameEngine.Scene):
         """
             Load Levels
         """
-        self.levelCount = 0
+        self.levelCount = 1
         self.currentLevel = LevelOne(self)
+        self.currentLevel.activate()
         self.ritzTileMapGroup = pygame.sprite.Group(self.currentLevel)
         self.addGroup(self.ritzTileMapGroup)
+        self.__preloadNextLevel()
+        
+    """
+        Next level is built on a loader thread while the current
+        level is played, then swapped in when ritz enters the door.
+        Its chunks are converted to the display format on the main
+        thread, when it is first rendered.
+    """
+    def __preloadNextLevel(self):
+        self.levelLoader = None
+        if self.levelCount + 1 in self.LEVELS:
+            self.levelLoader = gameEngine.AsyncLoader(self.__loadLevel, self.LEVELS[self.levelCount + 1])
+            self.levelLoader.start()
+            
+    def __loadLevel(self, levelClass):
+        level = levelClass(self)
+        level.centerOnRitz()
+        level.streamEntities()
+        return level
   
     def nextLevel(self): 
+        """
+            The door calls this every frame once ritz entered it, so
+            the swap waits here until the loader is done.
+        """
+        if self.levelLoader == None or not self.levelLoader.isReady():
+            return
         
         self.runningScore = self.currentLevel.scoreBoard.getScore()
         for sprite in self.currentLevel.topLayerGroup:
@@ -109,15 +151,12 @@ class GamePlayScene(gameEngine.Scene):
         self.ritzTileMapGroup.remove(self.currentLevel)
 
         self.levelCount += 1
-        
-        if self.levelCount == 2:
-            self.currentLevel = LevelTwo(self)
-        elif self.levelCount == 3:
-            self.currentLevel = LevelThree(self)
-        elif self.levelCount == 4:
-            self.currentLevel = LevelFour(self)
+        self.currentLevel = self.levelLoader.getResult()
+        self.currentLevel.activate()
         self.currentLevel.scoreBoard.addScore(self.runningScore)
         self.ritzTileMapGroup.add(self.currentLevel)
+        self.subscribeEvents(self.currentLevel)
+        self.__preloadNextLevel()
 
         
 class CreditScene(gameEngine.Scene):
@@ -133,7 +172,6 @@ class GameOverScene(gameEngine.Scene):
             Misc. Init
         """         
         self.setStopBounds(self.STOP_ANY_KEY)
-        resources.playMusic(resources.MFX_GAME_OVER, -1, 0.5)
 
         self.graveStoneSprite = miscellaneous.GraveStone((400, 470))
         self.gameOverText = gameEngine.MyFontSprite(self, (self.width / 2, 50), (200, 50), 
@@ -144,6 +182,9 @@ class GameOverScene(gameEngine.Scene):
                                                    self.graveStoneSprite, self.gameOverMap)
         
         self.addGroup(self.backgroundGroup)
+        
+    def enter(self):
+        resources.playMusic(resources.MFX_GAME_OVER, -1, 0.5)
             
     
 class StartScene(gameEngine.Scene):
@@ -154,7 +195,6 @@ class StartScene(gameEngine.Scene):
             Misc. Init
         """         
         self.setStopBounds(self.STOP_NEVER)
-        resources.playMusic(resources.MFX_INTRO_THEME)
         
         """
             Create and add sprite groups
@@ -172,6 +212,16 @@ class StartScene(gameEngine.Scene):
         self.backgroundGroup = pygame.sprite.Group(self.startSceneMap)
         self.addGroup(self.backgroundGroup)
         self.startSceneMap.addStaticGroup(self.staticGroup)
+        
+    """
+        Start scene is kept warm and reused, put ritz back in front
+        of the doors each time it is entered.
+    """
+    def enter(self):
+        resources.playMusic(resources.MFX_INTRO_THEME)
+        self.startSceneMap.respawnRitz()
+        self.playDoor.reset()
+        self.exitDoor.reset()
             
 
 
@@ -184,7 +234,6 @@ class InstructionsScene(gameEngine.Scene):
             Misc. Init
         """         
         self.setStopBounds(self.STOP_NEVER)
-        resources.playMusic(None)
         
         """
             Create and add sprite groups
@@ -217,6 +266,11 @@ class InstructionsScene(gameEngine.Scene):
 
         self.instructionSceneMap.addStaticGroup(self.staticGroup)
         
+    def enter(self):
+        resources.playMusic(None)
+        self.instructionSceneMap.respawnRitz()
+        self.instructionsDoor.reset()
+        
 class SplashScene(gameEngine.Scene):
     SPLASH_DEPLAY = 120
     def __init__(self, (width, height), title):
@@ -225,7 +279,6 @@ class SplashScene(gameEngine.Scene):
             Misc. Init
         """
         self.splashCount = 0
-        resources.playMusic(resources.MFX_SPLASHSCENE, 1, 0.3)
         
         """
             Create and add sprite groups
@@ -233,7 +286,10 @@ class SplashScene(gameEngine.Scene):
         self.backgroundSprite = gameEngine.MySprite(self, (self.width / 2, self.height / 2), "splashscreen.png")
         self.backgroundGroup = pygame.sprite.Group(self.backgroundSprite)
         self.addGroup(self.backgroundGroup)
-
+        
+    def enter(self):
+        self.splashCount = 0
+        resources.playMusic(resources.MFX_SPLASHSCENE, 1, 0.3)
         
     def update(self):
         gameEngine.Scene.update(self)
@@ -250,47 +306,88 @@ class SplashScene(gameEngine.Scene):
             self.splashCount += 1
 
 
+"""
+    Creates the scene manager and registers the game scenes.
+    The scene manager keeps the splash, instructions and start scenes warm
+    so going back to them does not rebuild the window or their maps.
+"""
+def createSceneManager():
+    sceneManager = gameEngine.SceneManager((800, 600))
+    sceneManager.register(SCENE_SPLASH, SplashScene, "Ritz by Justin Hellsten - Splash", True)
+    sceneManager.register(SCENE_INSTRUCTIONS, InstructionsScene, "Ritz by Justin Hellsten - Instructions", True)
+    sceneManager.register(SCENE_START, StartScene, "Ritz by Justin Hellsten - Start", True)
+    sceneManager.register(SCENE_PLAY, GamePlayScene, "Ritz by Justin Hellsten - Play")
+    sceneManager.register(SCENE_GAME_OVER, GameOverScene, "Ritz by Justin Hellsten - End")
+    sceneManager.register(SCENE_CREDITS, CreditScene, "Ritz by Justin Hellsten - Credit", True)
+    return sceneManager
+
+"""
+    Plays a recorded game and prints its frame times. The replay
+    uses the recorded seed and input so every run plays the same.
+"""
+def playReplay(fileName):
+    resources.init()
+    sceneManager = createSceneManager()
+    replay = gameEngine.ReplayPlayer(fileName)
+    gamePlayScene = sceneManager.push(SCENE_PLAY)
+    gamePlayScene.setReplay(replay)
+    sceneManager.run()
+    
+    frameTimes = sorted(gamePlayScene.frameTimes)
+    if frameTimes:
+        print("frames: {0}".format(len(frameTimes)))
+        print("mean: {0:.2f} ms".format(sum(frameTimes) / len(frameTimes) * 1000))
+        print("median: {0:.2f} ms".format(frameTimes[len(frameTimes) / 2] * 1000))
+        print("95th percentile: {0:.2f} ms".format(frameTimes[len(frameTimes) * 95 / 100] * 1000))
+        print("max: {0:.2f} ms".format(frameTimes[-1] * 1000))
+
 """
     The life of our program. Runs the game scenes sequentially.
-    Follows the order: Splash Scene, Start Scene, Play Scene, End Scene.          
+    Follows the order: Splash Scene, Start Scene, Play Scene, End Scene.
+    Run with --startup-report to print the startup times after the
+    first scene, --record <file> to record the play scene and
+    --replay <file> to play a recording back.
 """
 def main():
+    if "--replay" in sys.argv:
+        playReplay(sys.argv[sys.argv.index("--replay") + 1])
+        return
+    
+    recordFile = None
+    if "--record" in sys.argv:
+        recordFile = sys.argv[sys.argv.index("--record") + 1]
+        
     resources.init()
+    sceneManager = createSceneManager()
 
     sceneFlow = SCENE_SPLASH
     programExit = False
 
     while not programExit:
-        if sceneFlow == SCENE_SPLASH:
-            splashScene = SplashScene((800, 600), "Ritz by Justin Hellsten - Splash")
-            splashScene.start()
-            programExit = splashScene.exit
-        elif sceneFlow == SCENE_INSTRUCTIONS:
-            instructionScene = InstructionsScene((800, 600), "Ritz by Justin Hellsten - Instructions")
-            instructionScene.start()
-            programExit = instructionScene.exit
-        elif sceneFlow == SCENE_START:
-            startScene = StartScene((800, 600), "Ritz by Justin Hellsten - Start")
-            startScene.start()
-            programExit = startScene.exit
-        elif sceneFlow == SCENE_PLAY:
-            gamePlayScene = GamePlayScene((800, 600), "Ritz by Justin Hellsten - Play")
-            gamePlayScene.start()
-            programExit = gamePlayScene.exit
+        recorder = None
+        if sceneFlow == SCENE_GAME_OVER:
+            sceneManager.replace(sceneFlow, gamePlayScene.currentLevel.scoreBoard.score)
+        elif sceneFlow == SCENE_PLAY and recordFile != None:
+            # The seed must be set before the levels are built
+            recorder = gameEngine.ReplayRecorder(recordFile)
+            sceneManager.replace(sceneFlow).setRecorder(recorder)
+        else:
+            sceneManager.replace(sceneFlow)
+        scene = sceneManager.run()
+        programExit = scene.exit
+        if recorder != None:
+            recorder.close()
+        
+        if "--startup-report" in sys.argv and sceneFlow == SCENE_SPLASH:
+            gameEngine.printStartupReport()
+        
+        if sceneFlow == SCENE_PLAY:
+            gamePlayScene = scene
         elif sceneFlow == SCENE_GAME_OVER:
-            endGameScene = GameOverScene((800, 600), "Ritz by Justin Hellsten - End", 
-                                         gamePlayScene.currentLevel.scoreBoard.score)
-            endGameScene.start()
-            programExit = endGameScene.exit
             sceneFlow = SCENE_INSTRUCTIONS
-        elif sceneFlow == SCENE_CREDITS:
-            creditScene = CreditScene((800, 600), "Ritz by Justin Hellsten - Credit")
-            creditScene.start()
-            programExit = creditScene.exit
             
         sceneFlow += 1
         if sceneFlow > SCENE_CREDITS:
             sceneFlow = 0
 
 if __name__ == "__main__": main()
-    